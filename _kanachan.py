@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 
 import json
+import os
 import pathlib
+import struct
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from collections import Counter
 from typing import (
     Optional,
@@ -10,6 +15,7 @@ from typing import (
 import warnings
 
 import torch
+from loguru import logger
 
 from constants import (
     _NUM2TILE,
@@ -45,6 +51,20 @@ from kanachan.constants import (
 from kanachan.model_loader import load_model
 
 from hand_calculator import has_yihan, check_kokushi, calculate_shanten
+from batcher import InferenceBatcher
+from decision_cache import DecisionCache
+from fallback import choose_fallback
+from instrumentation import (
+    Instrumentation,
+    install as install_instrumentation,
+    observe_current,
+    uninstall as uninstall_instrumentation,
+)
+from mjai_schema import VALIDATORS
+from model_cache import get_model_digest, load_cached_model
+from profiling import ProfilingCapture
+from quantization import QUANTIZED_MODEL_SUFFIX, quantize_model, load_quantized_model
+from rules import RULES
 
 warnings.filterwarnings(
     "ignore", category=UserWarning, message=".*checkpoint_sequential.*"
@@ -56,6 +76,20 @@ warnings.filterwarnings(
 )
 
 
+# チェックポイントの固定長部分の形式．
+# GameState: 初期化済みか, 席, 各家の段位 x 4, 各家の点数 x 4
+_GAME_STATE_FORMAT = struct.Struct("<?b4b4i")
+# RoundState: 初期化済みか, 場風, 局, 本場, 供託, ドラ表示牌の数, ドラ表示牌 x 5,
+# 残り枚数, 手牌の数, 手牌 x 14, 副露の数, 副露 x 4, 自摸牌 (-1: なし),
+# 第一自摸か, 立直宣言 x 4, 立直中か, 嶺上自摸か, 喰い替え禁止牌の数,
+# 喰い替え禁止牌 x 4, フリテン, 進行の長さ, 各家の立直成立時の進行の長さ x 4 (-1: 未立直)
+# この後に進行が uint16 の配列として続く．
+_ROUND_STATE_FORMAT = struct.Struct("<?bbhhB5bbB14bB4Hb?4???B4bbH4h")
+_CHECKPOINT_MAGIC = b"KNCK"
+_CHECKPOINT_VERSION = 2
+_CHECKPOINT_HEADER_FORMAT = struct.Struct("<4sB")
+
+
 class GameState:
     def __init__(
         self,
@@ -76,7 +110,10 @@ class GameState:
         self.__player_scores = None
 
     def on_new_game(self) -> None:
-        pass
+        # 前の対局の席と点数を残さない．
+        self.__seat = None
+        self.__player_grades = None
+        self.__player_scores = None
 
     def on_new_round(self, seat: int, scores: List[int]) -> None:
         self.__seat = seat
@@ -139,6 +176,24 @@ class GameState:
         self.__assert_initialized()
         return self.__player_scores[seat]
 
+    def to_bytes(self) -> bytes:
+        if self.__player_grades is None:
+            return _GAME_STATE_FORMAT.pack(False, -1, 0, 0, 0, 0, 0, 0, 0, 0)
+        return _GAME_STATE_FORMAT.pack(
+            True, self.__seat, *self.__player_grades, *self.__player_scores
+        )
+
+    def from_bytes(self, data: bytes) -> None:
+        fields = _GAME_STATE_FORMAT.unpack(data)
+        if not fields[0]:
+            self.__seat = None
+            self.__player_grades = None
+            self.__player_scores = None
+            return
+        self.__seat = fields[1]
+        self.__player_grades = list(fields[2:6])
+        self.__player_scores = list(fields[6:10])
+
 
 class RoundState:
     def __init__(self) -> None:
@@ -158,6 +213,7 @@ class RoundState:
         self.__my_kuikae_tiles = None
         self.__my_zhenting = None
         self.__progression = None
+        self.__liqi_progression_lengths = None
 
     def on_new_round(
         self,
@@ -186,6 +242,8 @@ class RoundState:
         # self.__my_zhenting == 2: 立直中の栄和拒否による永続的なフリテン
         self.__my_zhenting = 0
         self.__progression = [0]
+        # 立直が成立した時点の進行の長さ．これ以降の打牌は立直者に対して安全である．
+        self.__liqi_progression_lengths = [None, None, None, None]
 
     def get_chang(self) -> int:
         return self.__chang
@@ -220,6 +278,9 @@ class RoundState:
     def copy_progression(self) -> List[int]:
         return list(self.__progression)
 
+    def get_liqi_progression_lengths(self) -> List[Optional[int]]:
+        return list(self.__liqi_progression_lengths)
+
     def __get_my_hand_counts(self) -> Counter:
         my_hand_counts = Counter()
         for tile in self.__my_hand:
@@ -747,6 +808,7 @@ class RoundState:
         if not self.__liqi_to_be_accepted[seat]:
             raise RuntimeError("TODO: (A suitable error message)")
         self.__liqi_to_be_accepted[seat] = False
+        self.__liqi_progression_lengths[seat] = len(self.__progression)
 
         if mine:
             self.__my_liqi = True
@@ -761,29 +823,515 @@ class RoundState:
             raise ValueError("TODO: (A suitable error message)")
         self.__my_zhenting = zhenting
 
+    def to_bytes(self) -> bytes:
+        if self.__progression is None:
+            return _ROUND_STATE_FORMAT.pack(*([False] + [0] * 50))
+
+        def padded(values: List[int], length: int) -> List[int]:
+            return list(values) + [0] * (length - len(values))
+
+        header = _ROUND_STATE_FORMAT.pack(
+            True,
+            self.__chang,
+            self.__index,
+            self.__ben_chang,
+            self.__deposits,
+            len(self.__dora_indicators),
+            *padded(self.__dora_indicators, 5),
+            self.__num_left_tiles,
+            len(self.__my_hand),
+            *padded(self.__my_hand, 14),
+            len(self.__my_fulu_list),
+            *padded(self.__my_fulu_list, 4),
+            -1 if self.__zimo_pai is None else self.__zimo_pai,
+            self.__my_first_zimo,
+            *self.__liqi_to_be_accepted,
+            self.__my_liqi,
+            self.__my_lingshang_zimo,
+            len(self.__my_kuikae_tiles),
+            *padded(self.__my_kuikae_tiles, 4),
+            self.__my_zhenting,
+            len(self.__progression),
+            *(-1 if length is None else length for length in self.__liqi_progression_lengths),
+        )
+        return header + array("H", self.__progression).tobytes()
+
+    def from_bytes(self, data: bytes) -> None:
+        fields = _ROUND_STATE_FORMAT.unpack_from(data)
+        if not fields[0]:
+            self.__init__()
+            return
+        self.__chang = fields[1]
+        self.__index = fields[2]
+        self.__ben_chang = fields[3]
+        self.__deposits = fields[4]
+        self.__dora_indicators = list(fields[6 : 6 + fields[5]])
+        self.__num_left_tiles = fields[11]
+        self.__my_hand = list(fields[13 : 13 + fields[12]])
+        self.__my_fulu_list = list(fields[28 : 28 + fields[27]])
+        self.__zimo_pai = None if fields[32] == -1 else fields[32]
+        self.__my_first_zimo = fields[33]
+        self.__liqi_to_be_accepted = list(fields[34:38])
+        self.__my_liqi = fields[38]
+        self.__my_lingshang_zimo = fields[39]
+        self.__my_kuikae_tiles = list(fields[41 : 41 + fields[40]])
+        self.__my_zhenting = fields[45]
+        num_progression = fields[46]
+        self.__liqi_progression_lengths = [
+            None if length == -1 else length for length in fields[47:51]
+        ]
+        progression = array("H")
+        progression.frombytes(
+            data[_ROUND_STATE_FORMAT.size : _ROUND_STATE_FORMAT.size + 2 * num_progression]
+        )
+        if len(progression) != num_progression:
+            raise RuntimeError("A truncated `RoundState` checkpoint.")
+        self.__progression = progression.tolist()
+
+
+# 推論時の系列長の候補．入力は最も近いバケットの長さまでパディングされる．
+_PROGRESSION_BUCKETS = tuple(
+    b for b in (32, 64, 128, 256) if b < MAX_LENGTH_OF_PROGRESSION_FEATURES
+) + (MAX_LENGTH_OF_PROGRESSION_FEATURES,)
+_CANDIDATES_BUCKETS = tuple(
+    b for b in (8, 16) if b < MAX_NUM_ACTION_CANDIDATES
+) + (MAX_NUM_ACTION_CANDIDATES,)
+
+
+def _configure_dynamo_for_buckets() -> None:
+    # バケットごとのコンパイル済みモデルは全て同じ `forward` のコードオブジェクトに
+    # キャッシュされる．再コンパイルの上限 (既定では 8) がバケット数より小さいと，
+    # 上限を超えたバケットは警告のみで eager 実行に戻ってしまう．`compile` が有効な
+    # ときに限り，上限をバケット数まで引き上げる (下げることはしない)．
+    import torch._dynamo
+
+    config = torch._dynamo.config
+    num_buckets = len(_PROGRESSION_BUCKETS) * len(_CANDIDATES_BUCKETS)
+    name = "recompile_limit" if hasattr(config, "recompile_limit") else "cache_size_limit"
+    if getattr(config, name) < num_buckets:
+        setattr(config, name, num_buckets)
+    # それでも上限に達した場合は，黙って eager 実行に戻さずに例外を送出させる．
+    for name in ("fail_on_recompile_limit_hit", "fail_on_cache_limit_hit"):
+        if hasattr(config, name):
+            setattr(config, name, True)
+            break
+
+
+# 1回の `Kanachan.run` の呼び出しで最後のメッセージでなければならない種類と，
+# そうでない場合のエラーメッセージ．
+_LAST_MESSAGE_TYPES = {
+    "hello": "A multi-line `hello` message.",
+    "start_game": "Too many messages starting with `start_game`.",
+    "end_game": "An `end_game` message followed by other messages.",
+}
+
+
+def _get_bucket(length: int, buckets: tuple) -> int:
+    for bucket in buckets:
+        if length <= bucket:
+            return bucket
+    raise RuntimeError(f"A too long input (length = {length}, buckets = {buckets}).")
+
+
+# DEFAULT_MODEL_PATH = f"{pathlib.Path(__file__).parent}/model/model.kanachan"
+DEFAULT_MODEL_PATH = f"{pathlib.Path(__file__).parent}/model/model.25011200.kanachan"
+
+
+def configure_runtime(
+    *,
+    num_threads: Optional[int] = None,
+    num_interop_threads: Optional[int] = None,
+    cpu_affinity: Optional[List[int]] = None,
+) -> None:
+    if cpu_affinity is not None:
+        if not hasattr(os, "sched_setaffinity"):
+            warnings.warn("CPU affinity is not supported on this platform.")
+        else:
+            os.sched_setaffinity(0, cpu_affinity)
+
+    if num_threads is not None:
+        if num_threads < 1:
+            raise RuntimeError(f"An invalid number of threads (num_threads = {num_threads}).")
+        torch.set_num_threads(num_threads)
+
+    if num_interop_threads is not None:
+        if num_interop_threads < 1:
+            raise RuntimeError(
+                f"An invalid number of inter-op threads (num_interop_threads = {num_interop_threads})."
+            )
+        if torch.get_num_interop_threads() != num_interop_threads:
+            # inter-op スレッド数はプロセス内で並列処理が始まる前に1度だけしか
+            # 設定できない．
+            try:
+                torch.set_num_interop_threads(num_interop_threads)
+            except RuntimeError as e:
+                warnings.warn(f"Failed to set the number of inter-op threads: {e}")
+
+
+def resolve_device(device: str) -> torch.device:
+    if device == "auto":
+        return torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = torch.device(device)
+    if device.type == "cuda" and not torch.cuda.is_available():
+        raise RuntimeError(f"CUDA is not available (device = {device}).")
+    return device
+
+
+def describe_model(model_path: str, quantize: bool, cache_dir: Optional[str] = None) -> str:
+    # 同じファイルでも量子化の有無によって決定が変わる．
+    quantized = quantize or model_path.endswith(QUANTIZED_MODEL_SUFFIX)
+    digest = get_model_digest(model_path, cache_dir)
+    return f"{digest}:{'int8' if quantized else 'fp32'}"
+
+
+def get_loaded_model_digest(model: torch.nn.Module) -> Optional[str]:
+    # `load_kanachan_model` で読み込まれたモデルだけが持つ．
+    return getattr(model, "kanachan_digest", None)
+
+
+def load_kanachan_model(
+    model_path: str,
+    device: torch.device,
+    quantize: bool,
+    *,
+    use_cache: bool = True,
+    cache_dir: Optional[str] = None,
+) -> torch.nn.Module:
+    if quantize or model_path.endswith(QUANTIZED_MODEL_SUFFIX):
+        if device.type != "cpu":
+            raise RuntimeError(f"A quantized model can only run on CPU (device = {device}).")
+    if model_path.endswith(QUANTIZED_MODEL_SUFFIX):
+        model = load_quantized_model(model_path)
+    else:
+        model = None
+        if use_cache:
+            model = load_cached_model(model_path, cache_dir)
+        if model is None:
+            # キャッシュが存在しないか古い場合．
+            model = load_model(model_path, map_location=device)
+        model.to(device=device, dtype=torch.float32)
+        if quantize:
+            model = quantize_model(model)
+    model.eval()
+    # 決定キャッシュの鍵にするため，実際に読み込んだファイルを記録する．
+    model.kanachan_digest = describe_model(model_path, quantize, cache_dir)
+    return model
+
 
 class Kanachan:
     def __init__(
         self,
-        # model_path=f"{pathlib.Path(__file__).parent}/model/model.kanachan",
-        model_path=f"{pathlib.Path(__file__).parent}/model/model.25011200.kanachan",
+        model_path: str = DEFAULT_MODEL_PATH,
+        *,
+        quantize: Optional[bool] = None,
+        device: Optional[str] = None,
+        num_threads: Optional[int] = None,
+        num_interop_threads: Optional[int] = None,
+        cpu_affinity: Optional[List[int]] = None,
+        batcher: Optional[InferenceBatcher] = None,
+        model: Optional[torch.nn.Module] = None,
+        model_cache: Optional[bool] = None,
+        model_cache_dir: Optional[str] = None,
+        bucketed_padding: Optional[bool] = None,
+        compile: Optional[bool] = None,
+        rule_overrides: Optional[List[str]] = None,
+        decision_cache: Optional[DecisionCache] = None,
+        decision_cache_size: Optional[int] = None,
+        decision_deadline: Optional[float] = None,
+        warmup: Optional[bool] = None,
+        checkpoint_path: Optional[str] = None,
+        trusted: Optional[bool] = None,
+        instrumentation: Optional[Instrumentation] = None,
+        profiler: Optional[ProfilingCapture] = None,
     ) -> None:
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        self.device = "cpu"
-        self.__model = load_model(model_path, map_location=self.device)
-        self.__model.to(device=self.device, dtype=torch.float32)
-        self.__model.eval()
-
         with open(f"{pathlib.Path(__file__).parent}/game.json", encoding="UTF-8") as f:
             game_config = json.load(f)
-            self.__game_state = GameState(
-                my_name=game_config["my_name"],
-                room=game_config["room"],
-                game_style=game_config["game_style"],
-                my_grade=game_config["my_grade"],
-                opponent_grade=game_config["opponent_grade"],
+
+        # コンストラクタの引数が `game.json` の設定より優先される．
+        def option(name: str, value, default):
+            if value is not None:
+                return value
+            return game_config.get(name, default)
+
+        quantize = option("quantize", quantize, False)
+        configure_runtime(
+            num_threads=option("num_threads", num_threads, None),
+            num_interop_threads=option("num_interop_threads", num_interop_threads, None),
+            cpu_affinity=option("cpu_affinity", cpu_affinity, None),
+        )
+
+        if batcher is not None and model is not None:
+            raise RuntimeError("Both `batcher` and `model` are specified.")
+        self.__batcher = batcher
+        if batcher is not None:
+            # モデルは `batcher` が保持しており，複数のセッションで共有される．
+            self.device = batcher.get_device()
+            self.__model = None
+            self.__model_digest = batcher.get_model_digest()
+        elif model is not None:
+            # 呼び出し側で読み込まれたモデルを共有する．
+            parameter = next(model.parameters(), None)
+            self.device = parameter.device if parameter is not None else torch.device("cpu")
+            self.__model = model
+            self.__model_digest = get_loaded_model_digest(model)
+        else:
+            # モデルは最初の推論の直前に読み込まれる．
+            self.device = resolve_device(option("device", device, "cpu"))
+            self.__model = None
+            # `model_path` と `quantize` から最初の推論の直前に求める．
+            self.__model_digest = None
+        self.__model_path = model_path
+        self.__quantize = quantize
+        self.__model_cache = option("model_cache", model_cache, True)
+        self.__model_cache_dir = option("model_cache_dir", model_cache_dir, None)
+        self.__bucketed_padding = option("bucketed_padding", bucketed_padding, False)
+        self.__compile = option("compile", compile, False)
+        if self.__compile and batcher is not None:
+            raise RuntimeError("`compile` cannot be used with `batcher`.")
+        if self.__compile:
+            _configure_dynamo_for_buckets()
+        self.__compiled_models = {}
+
+        self.__rules = []
+        for name in option("rule_overrides", rule_overrides, []):
+            if name not in RULES:
+                raise RuntimeError(f"An unknown rule override (name = {name}).")
+            self.__rules.append(RULES[name])
+
+        # `decision_cache` を渡すと複数のセッションで1つのキャッシュを共有する．
+        if decision_cache is None:
+            decision_cache_size = option("decision_cache_size", decision_cache_size, 0)
+            if decision_cache_size > 0:
+                decision_cache = DecisionCache(decision_cache_size)
+        self.__decision_cache = decision_cache
+        if decision_cache is not None and self.__model_digest is None:
+            if batcher is not None or model is not None:
+                # `model_path` は使われているモデルを表さないので，鍵にできない．
+                raise RuntimeError(
+                    "The decision cache requires a model loaded by `load_kanachan_model`."
+                )
+
+        if self.__bucketed_padding:
+            # エンコーダがパディングをマスクしない場合，パディング長によって
+            # 出力が変わりうる．バッチャはバッチ内の最長の入力に合わせてパディングし
+            # 直し，決定キャッシュは自身のパディングで鍵を作るので，どちらとも
+            # 組み合わせられない．
+            if batcher is not None:
+                raise RuntimeError("`bucketed_padding` cannot be used with `batcher`.")
+            if decision_cache is not None:
+                raise RuntimeError("`bucketed_padding` cannot be used with a decision cache.")
+            logger.warning(
+                "`bucketed_padding` is not verified to preserve decisions; "
+                "compare it with `replay.py --candidate bucketed_padding=true` first."
             )
+
+        # 推論が `decision_deadline` 秒以内に終わらなければ，フォールバック方策で
+        # 応答する．推論は別スレッドで実行し，打ち切られた推論はそのまま完了させる．
+        # 打ち切られた推論が終わるまでは新たな推論を投入せず，直ちにフォールバック
+        # する．投入すると後続の推論が全てその後ろで待たされて期限を過ぎるため．
+        self.__decision_deadline = option("decision_deadline", decision_deadline, None)
+        self.__executor = None
+        self.__in_flight = None
+        if self.__decision_deadline is not None:
+            if self.__decision_deadline <= 0.0:
+                raise RuntimeError(
+                    f"An invalid deadline (decision_deadline = {self.__decision_deadline})."
+                )
+            self.__executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="KanachanInference"
+            )
+
+        self.__game_state = GameState(
+            my_name=game_config["my_name"],
+            room=game_config["room"],
+            game_style=game_config["game_style"],
+            my_grade=game_config["my_grade"],
+            opponent_grade=game_config["opponent_grade"],
+        )
         self.__round_state = RoundState()
+        self.__num_decisions = 0
+        self.__num_forward_passes = 0
+        self.__num_skipped_forward_passes = 0
+        self.__game_num_skipped_forward_passes = 0
+        self.__num_fallbacks = 0
+        self.__num_caught_up_decisions = 0
+
+        self.__catching_up = False
+        # 追いつきモードで処理中のメッセージ列と，次のメッセージの位置．
+        # 過去の決定点で実際に選ばれた応答を知るために使う．
+        self.__catch_up_messages = []
+        self.__catch_up_next = 0
+        # `checkpoint_path` が指定されていれば， `run`, `feed`, `catch_up` の
+        # 呼び出しごとにセッションのチェックポイントを書き出す．
+        self.__checkpoint_path = option("checkpoint_path", checkpoint_path, None)
+
+        # 変換済みの牌譜やシミュレータなど，信頼できる送信元からのメッセージは
+        # 検証しない．
+        self.__trusted = option("trusted", trusted, False)
+
+        # `instrumentation` を渡すと各段階の所要時間をヒストグラムに記録する．
+        # 渡さなければ計測のための関数のラップも行われない．ラップは `close` で
+        # 外される (他に計装された `Kanachan` が残っていなければ)．
+        self.__instrumentation = instrumentation
+        self.__instrumentation_installed = instrumentation is not None
+        if instrumentation is not None:
+            install_instrumentation()
+
+        # `profiler` が要求を受けると，次のいくつかのフォワードパスとその間の
+        # ハンドラをプロファイルする．
+        self.__profiler = profiler
+
+        # メッセージの種類 -> (ハンドラ, ハンドラの戻り値が応答になるかどうか)
+        self.__dispatch_table = {
+            "hello": (self.__on_hello, True),
+            "start_game": (self.__on_start_game, True),
+            "start_kyoku": (self.__on_start_kyoku, False),
+            "tsumo": (self.__on_zimo, True),
+            "dahai": (self.__on_dapai, True),
+            "chi": (self.__on_chi, True),
+            "pon": (self.__on_peng, True),
+            "daiminkan": (self.__on_daminggang, False),
+            "ankan": (self.__on_angang, True),
+            "kakan": (self.__on_jiagang, True),
+            "reach": (self.__on_liqi, False),
+            "reach_accepted": (self.__on_liqi_acceptance, False),
+            "dora": (self.__on_new_dora, False),
+            "hora": (self.__on_hulu, False),
+            "ryukyoku": (self.__on_luju, False),
+            "end_kyoku": (self.__on_round_end, True),
+            "end_game": (self.__on_game_end, True),
+        }
+
+        # 期限がある場合，遅延読み込みではセッション最初の推論が読み込みごと
+        # 期限を過ぎてフォールバックになるので，ここで読み込んでおく．
+        if self.__decision_deadline is not None and self.__batcher is None:
+            self.__get_model()
+
+        self.__warmup_report = None
+        if option("warmup", warmup, False):
+            self.warmup()
+
+    def warmup(self, num_iterations: int = 3) -> dict:
+        # 合成した入力で，セッション中に現れる全ての入力形状について推論を行う．
+        # 初回の推論にはアロケータの初期化やカーネルの選択などが含まれる．
+        if num_iterations < 2:
+            raise RuntimeError(f"An invalid number of iterations (num_iterations = {num_iterations}).")
+
+        start = time.perf_counter()
+        if self.__batcher is None:
+            self.__get_model()
+        model_load_seconds = time.perf_counter() - start
+
+        if self.__bucketed_padding:
+            shapes = [(p, c) for p in _PROGRESSION_BUCKETS for c in _CANDIDATES_BUCKETS]
+        else:
+            shapes = [(MAX_LENGTH_OF_PROGRESSION_FEATURES, MAX_NUM_ACTION_CANDIDATES)]
+
+        sparse = [0, 5, 7, 23, 39, 55, 71, 75, 78, 82 + 69, 152]
+        for i in range(len(sparse), MAX_NUM_ACTIVE_SPARSE_FEATURES):
+            sparse.append(NUM_TYPES_OF_SPARSE_FEATURES)
+        sparse = torch.tensor(sparse, device=self.device, dtype=torch.int32).unsqueeze(0)
+        numeric = torch.tensor(
+            [0.0, 0.0, 2.5, 2.5, 2.5, 2.5], device=self.device, dtype=torch.float32
+        ).unsqueeze(0)
+
+        shape_reports = []
+        for progression_length, candidates_length in shapes:
+            progression = [0]
+            for i in range(len(progression), progression_length):
+                progression.append(NUM_TYPES_OF_PROGRESSION_FEATURES)
+            progression = torch.tensor(
+                progression, device=self.device, dtype=torch.int32
+            ).unsqueeze(0)
+
+            # 打牌の候補を `candidates_length` 個並べる．
+            candidates = [tile * 4 for tile in range(candidates_length)]
+            candidates = torch.tensor(
+                candidates, device=self.device, dtype=torch.int32
+            ).unsqueeze(0)
+
+            latencies = []
+            for i in range(num_iterations):
+                iteration_start = time.perf_counter()
+                with torch.no_grad():
+                    self.__forward(sparse, numeric, progression, candidates)
+                latencies.append(time.perf_counter() - iteration_start)
+            warm_latencies = sorted(latencies[1:])
+            shape_reports.append(
+                {
+                    "progression_length": progression_length,
+                    "candidates_length": candidates_length,
+                    "cold_seconds": latencies[0],
+                    "warm_seconds": warm_latencies[len(warm_latencies) // 2],
+                }
+            )
+
+        self.__warmup_report = {
+            "model_load_seconds": model_load_seconds,
+            "cold_seconds": shape_reports[0]["cold_seconds"],
+            "warm_seconds": max(r["warm_seconds"] for r in shape_reports),
+            "shapes": shape_reports,
+        }
+        return self.__warmup_report
+
+    def get_warmup_report(self) -> Optional[dict]:
+        return self.__warmup_report
+
+    def checkpoint(self) -> bytes:
+        return (
+            _CHECKPOINT_HEADER_FORMAT.pack(_CHECKPOINT_MAGIC, _CHECKPOINT_VERSION)
+            + self.__game_state.to_bytes()
+            + self.__round_state.to_bytes()
+        )
+
+    def restore(self, data: bytes) -> None:
+        magic, version = _CHECKPOINT_HEADER_FORMAT.unpack_from(data)
+        if magic != _CHECKPOINT_MAGIC:
+            raise RuntimeError(f"Not a `Kanachan` checkpoint (magic = {magic}).")
+        if version != _CHECKPOINT_VERSION:
+            raise RuntimeError(f"An unsupported checkpoint version (version = {version}).")
+        offset = _CHECKPOINT_HEADER_FORMAT.size
+        self.__game_state.from_bytes(data[offset : offset + _GAME_STATE_FORMAT.size])
+        offset += _GAME_STATE_FORMAT.size
+        self.__round_state.from_bytes(data[offset:])
+
+    def save_checkpoint(self, path: str) -> None:
+        # 書き込み途中でクラッシュしても古いチェックポイントが残るようにする．
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, mode="wb") as f:
+            f.write(self.checkpoint())
+        os.replace(tmp_path, path)
+
+    def load_checkpoint(self, path: str) -> None:
+        with open(path, mode="rb") as f:
+            self.restore(f.read())
+
+    def __on_processed(self) -> None:
+        if self.__checkpoint_path is not None:
+            self.save_checkpoint(self.__checkpoint_path)
+
+    def close(self) -> None:
+        # 推論用のスレッドを終了させ，計装のラップを外す．実行中の推論は待たない．
+        if self.__executor is not None:
+            self.__executor.shutdown(wait=False, cancel_futures=True)
+            self.__executor = None
+            self.__in_flight = None
+        if self.__instrumentation_installed:
+            uninstall_instrumentation()
+            self.__instrumentation_installed = False
+
+    def get_stats(self) -> dict:
+        stats = {
+            "decisions": self.__num_decisions,
+            "forward_passes": self.__num_forward_passes,
+            "skipped_forward_passes": self.__num_skipped_forward_passes,
+            "game_skipped_forward_passes": self.__game_num_skipped_forward_passes,
+            "fallbacks": self.__num_fallbacks,
+            "caught_up_decisions": self.__num_caught_up_decisions,
+        }
+        if self.__decision_cache is not None:
+            stats["decision_cache"] = self.__decision_cache.get_metrics()
+        return stats
 
     def __on_hello(self, message: dict) -> dict:
         assert message["type"] == "hello"
@@ -813,79 +1361,24 @@ class Kanachan:
         #        f'A `start_game` message with an invalid `id` (id = {seat}).')
         # self.__game_state.on_new_game(seat)
 
+        # 読み込んだモデルや設定はそのままに，対局と局の状態だけを初期化する．
+        # これにより1つのインスタンスで複数の対局を続けて処理できる．
         self.__game_state.on_new_game()
+        self.__round_state = RoundState()
+        self.__game_num_skipped_forward_passes = 0
 
         return {"type": "none"}
 
     def __on_start_kyoku(self, message: dict) -> None:
         assert message["type"] == "start_kyoku"
 
-        if "bakaze" not in message:
-            raise RuntimeError("A `start_kyoku` message without the `bakaze` key.")
-        chang = message["bakaze"]
-        if chang not in ("E", "S", "W"):
-            raise RuntimeError(
-                f"A `start_kyoku` message with an invalid `bakaze` (bakaze = {chang})."
-            )
-        chang = {"E": 0, "S": 1, "W": 2}[chang]
-
-        if "kyoku" not in message:
-            raise RuntimeError("A `start_kyoku` message without the `kyoku` key.")
-        round_index = message["kyoku"]
-        if round_index < 1 or 4 < round_index:
-            raise RuntimeError(
-                f"A `start_kyoku` message with an invalid `kyoku` (kyoku = {round_index})."
-            )
-        round_index -= 1
-
-        if "honba" not in message:
-            raise RuntimeError("A `start_kyoku` message without the `honba` key.")
+        chang = {"E": 0, "S": 1, "W": 2}[message["bakaze"]]
+        round_index = message["kyoku"] - 1
         ben_chang = message["honba"]
-        if ben_chang < 0:
-            raise RuntimeError(
-                f"A `start_kyoku` message with an invalid `honba` (honba = {ben_chang})."
-            )
-
-        if "kyotaku" not in message:
-            raise RuntimeError("A `start_kyoku` message without the `kyotaku` key.")
         deposits = message["kyotaku"]
-        if deposits < 0:
-            raise RuntimeError(
-                f"A `start_kyoku` message with an invalid `kyotaku` (kyotaku = {deposits})."
-            )
-
-        if "oya" not in message:
-            raise RuntimeError("A `start_kyoku` message without the `oya` key.")
-        dealer = message["oya"]
-        if dealer != round_index:
-            raise RuntimeError(
-                f"An inconsistent `start_kyoku` message (round_index = {round_index}, oya = {dealer})."
-            )
-
-        if "dora_marker" not in message:
-            raise RuntimeError("A `start_kyoku` message without the `dora_marker` key.")
-        dora_indicator = message["dora_marker"]
-        if dora_indicator not in _TILE2NUM:
-            raise RuntimeError(
-                "A `start_kyoku` message with an invalid `dora_marker` (dora_marker = {dora_indicator})."
-            )
-        dora_indicator = _TILE2NUM[dora_indicator]
-
-        if "scores" not in message:
-            raise RuntimeError("A `start_kyoku` message without the `scores` key.")
+        dora_indicator = _TILE2NUM[message["dora_marker"]]
         scores = message["scores"]
-        if len(scores) != 4:
-            raise RuntimeError(
-                f"A `start_kyoku` message with an invalid scores (length = {len(scores)})."
-            )
-
-        if "tehais" not in message:
-            raise RuntimeError("A `start_kyoku` message without the `tehais` key.")
         hands = message["tehais"]
-        if len(hands) != 4:
-            raise RuntimeError(
-                f"A `start_kyoku` message with an wrong `tehais` (length = {len(hands)})."
-            )
 
         # 2022/10/06 時点でのAI雀荘の実装では， `start_game` メッセージに
         # `id` キーが伴わないように推定されるので，その時点では `seat` を
@@ -893,51 +1386,49 @@ class Kanachan:
         seat = None
         for i in range(4):
             if hands[i][0] != "?":
-                if seat is not None:
-                    raise RuntimeError("TODO: (A suitable error message)")
                 seat = i
+                break
         if seat is None:
-            raise RuntimeError("TODO: (A suitable error message)")
-
-        for i, hand in enumerate(hands):
-            if i != seat:
-                if hand != [
-                    "?",
-                    "?",
-                    "?",
-                    "?",
-                    "?",
-                    "?",
-                    "?",
-                    "?",
-                    "?",
-                    "?",
-                    "?",
-                    "?",
-                    "?",
-                ]:
-                    raise RuntimeError(
-                        f"A `start_kyoku` message with an wrong `tehais` (seat = {seat}, i = {i}, hand = {hand})."
-                    )
-            else:
-                if len(hand) != 13:
-                    raise RuntimeError(
-                        f"A `start_kyoku` message with an wrong `tehais` (seat = {seat}, hand = {hand})."
-                    )
-                for i in range(13):
-                    if hand[i] not in _TILE2NUM:
-                        raise RuntimeError(
-                            f"A `start_kyoku` message with an wrong `tehais` (seat = {seat}, hand = {hand})."
-                        )
-                    hand[i] = _TILE2NUM[hand[i]]
+            raise RuntimeError("A `start_kyoku` message without the own `tehais`.")
         hand = hands[seat]
+        for i in range(13):
+            hand[i] = _TILE2NUM[hand[i]]
 
         self.__game_state.on_new_round(seat, scores)
         self.__round_state.on_new_round(
             chang, round_index, ben_chang, deposits, dora_indicator, hand
         )
 
-    def __respond(self, dapai: Optional[int], candidates: List[int]) -> dict:
+    def __get_model(self) -> torch.nn.Module:
+        if self.__model is None:
+            self.__model = load_kanachan_model(
+                self.__model_path,
+                self.device,
+                self.__quantize,
+                use_cache=self.__model_cache,
+                cache_dir=self.__model_cache_dir,
+            )
+        return self.__model
+
+    def __forward(
+        self,
+        sparse: torch.Tensor,
+        numeric: torch.Tensor,
+        progression: torch.Tensor,
+        candidates: torch.Tensor,
+    ) -> tuple:
+        if self.__batcher is not None:
+            return self.__batcher.infer(sparse, numeric, progression, candidates)
+        model = self.__get_model()
+        if self.__compile:
+            # バケットごとに別々のグラフをコンパイルする．
+            bucket = (progression.size(1), candidates.size(1))
+            if bucket not in self.__compiled_models:
+                self.__compiled_models[bucket] = torch.compile(model, dynamic=False)
+            model = self.__compiled_models[bucket]
+        return model(sparse, numeric, progression, candidates)
+
+    def __encode(self, candidates: List[int]) -> tuple:
         seat = self.__game_state.get_seat()
 
         sparse = []
@@ -997,7 +1488,7 @@ class Kanachan:
 
         for i in range(len(sparse), MAX_NUM_ACTIVE_SPARSE_FEATURES):
             sparse.append(NUM_TYPES_OF_SPARSE_FEATURES)
-        sparse = torch.tensor(sparse, device="cpu", dtype=torch.int32).unsqueeze(0)
+        sparse = torch.tensor(sparse, device=self.device, dtype=torch.int32).unsqueeze(0)
 
         numeric = []
         numeric.append(self.__round_state.get_num_ben_chang())
@@ -1009,31 +1500,109 @@ class Kanachan:
                 numeric.append(player_score / 10000.0)
             else:
                 numeric.append(0.0)
-        numeric = torch.tensor(numeric, device="cpu", dtype=torch.float32).unsqueeze(0)
+        numeric = torch.tensor(numeric, device=self.device, dtype=torch.float32).unsqueeze(0)
 
         progression = self.__round_state.copy_progression()
-        for i in range(len(progression), MAX_LENGTH_OF_PROGRESSION_FEATURES):
+        if self.__bucketed_padding:
+            progression_length = _get_bucket(len(progression), _PROGRESSION_BUCKETS)
+        else:
+            progression_length = MAX_LENGTH_OF_PROGRESSION_FEATURES
+        for i in range(len(progression), progression_length):
             progression.append(NUM_TYPES_OF_PROGRESSION_FEATURES)
         progression = torch.tensor(
-            progression, device="cpu", dtype=torch.int32
+            progression, device=self.device, dtype=torch.int32
         ).unsqueeze(0)
 
         candidates_ = list(candidates)
-        for i in range(len(candidates_), MAX_NUM_ACTION_CANDIDATES):
+        if self.__bucketed_padding:
+            candidates_length = _get_bucket(len(candidates_), _CANDIDATES_BUCKETS)
+        else:
+            candidates_length = MAX_NUM_ACTION_CANDIDATES
+        for i in range(len(candidates_), candidates_length):
             candidates_.append(NUM_TYPES_OF_ACTIONS)
         candidates_ = torch.tensor(
-            candidates_, device="cpu", dtype=torch.int32
+            candidates_, device=self.device, dtype=torch.int32
         ).unsqueeze(0)
 
+        return sparse, numeric, progression, candidates_
+
+    def __get_model_digest(self) -> str:
+        if self.__model_digest is None:
+            self.__model_digest = describe_model(
+                self.__model_path, self.__quantize, self.__model_cache_dir
+            )
+        return self.__model_digest
+
+    def __infer(self, candidates: List[int], start: float) -> tuple:
+        # (推論の結果, フォールバックの理由) を返す．推論の結果が `None` の場合，
+        # 呼び出し側はフォールバック方策で応答する．
+        instrumented = self.__instrumentation is not None
+        if instrumented:
+            t = time.perf_counter()
+        sparse, numeric, progression, candidates_ = self.__encode(candidates)
+        if instrumented:
+            t = self.__observe("encode", t)
+
+        key = None
+        if self.__decision_cache is not None:
+            self.__decision_cache.bind(self.__get_model_digest())
+            key = DecisionCache.make_key(sparse, numeric, progression, candidates_)
+            cached = self.__decision_cache.get(key)
+            if instrumented:
+                t = self.__observe("decision_cache", t)
+            if cached is not None:
+                return cached, None
+
+        if self.__executor is None:
+            action, proportions = self.__run_model(
+                sparse, numeric, progression, candidates_, len(candidates)
+            )
+        else:
+            if self.__in_flight is not None and not self.__in_flight.done():
+                # フォワードパスを行っていないので何も記録しない．
+                return None, "a previous inference is still running past its deadline"
+            future = self.__executor.submit(
+                self.__run_model, sparse, numeric, progression, candidates_, len(candidates)
+            )
+            self.__in_flight = future
+            timeout = max(self.__decision_deadline - (time.perf_counter() - start), 0.0)
+            try:
+                action, proportions = future.result(timeout=timeout)
+            except FutureTimeoutError:
+                # 完了していないフォワードパスは `forward` のレイテンシに含めない．
+                if instrumented:
+                    self.__observe("forward_abandoned", t)
+                return None, (
+                    f"inference exceeded the deadline of {self.__decision_deadline:.3f} seconds"
+                )
+        if instrumented:
+            self.__observe("forward", t)
+        if key is not None:
+            self.__decision_cache.put(key, action, proportions)
+        return (action, proportions), None
+
+    def __run_model(
+        self,
+        sparse: torch.Tensor,
+        numeric: torch.Tensor,
+        progression: torch.Tensor,
+        candidates_: torch.Tensor,
+        num_candidates: int,
+    ) -> tuple:
+        self.__num_forward_passes += 1
         with torch.no_grad():
-            progression = self.__model(sparse, numeric, progression, candidates_)
-            candidates_ = torch.squeeze(candidates_, dim=0)
+            if self.__profiler is not None and self.__profiler.is_armed():
+                progression = self.__profiler.profile_forward(
+                    self.__forward, sparse, numeric, progression, candidates_
+                )
+            else:
+                progression = self.__forward(sparse, numeric, progression, candidates_)
             if len(progression) == 3:
                 action = progression[2].squeeze(dim=0).item()
 
                 decode = progression[1]
                 decode = decode.squeeze(dim=0)
-                decode = decode[: len(candidates)]
+                decode = decode[:num_candidates]
 
                 min_value = torch.min(decode)
                 shifted_tensor_data = decode - min_value
@@ -1045,7 +1614,7 @@ class Kanachan:
 
                 decode = progression[2]
                 decode = decode.squeeze(dim=0)
-                decode = decode[: len(candidates)]
+                decode = decode[:num_candidates]
 
                 min_value = torch.min(decode)
                 shifted_tensor_data = decode - min_value
@@ -1054,8 +1623,16 @@ class Kanachan:
                 proportions = shifted_tensor_data / sum_of_elements
             else:
                 raise ValueError()
-        decision = candidates_[action].item()
+        if action >= num_candidates:
+            raise RuntimeError(
+                f"An invalid action (action = {action}, num_candidates = {num_candidates})."
+            )
 
+        return action, proportions
+
+    def __format_decision(
+        self, candidates: List[int], action: int, proportions: torch.Tensor, decision: int
+    ) -> dict:
         mask_unicode_4p_dict = {}
 
         def mask_prob(index: int) -> str:
@@ -1118,14 +1695,78 @@ class Kanachan:
 
             raise RuntimeError(f"An invalid decision (decision = {decision}).")
 
-        print(f"Decision: {mask_unicode_4p_dict}")
-        # print("Elements: ", end="")
-        #     for i, element in enumerate(proportions):
-        #         if i == action:
-        #             print(f"{i}: [{element.item():.2f}] ", end="")
-        #         else:
-        #             print(f"{i}: {element.item():.2f} ", end="")
-        # print()
+        return mask_unicode_4p_dict
+
+    def __decide_without_model(
+        self, dapai: Optional[int], candidates: List[int]
+    ) -> Optional[int]:
+        if len(candidates) == 1:
+            # 合法手が1つしかない．
+            return candidates[0]
+        for rule in self.__rules:
+            decision = rule(self.__game_state, self.__round_state, dapai, candidates)
+            if decision is not None:
+                if decision not in candidates:
+                    raise RuntimeError(
+                        f"A rule override chose an illegal decision (decision = {decision}, candidates = {candidates})."
+                    )
+                return decision
+        return None
+
+    def __respond(self, dapai: Optional[int], candidates: List[int]) -> Optional[dict]:
+        if self.__catching_up:
+            # 過去の決定点なので推論しない．栄和が選択肢にあり，後続のメッセージが
+            # 自分の和了でも副露でもなければ見逃し (221) が選ばれたので，通常の
+            # 応答と同様にフリテンを設定する．
+            if any(i in candidates for i in (543, 544, 545)) and not self.__caught_up_call():
+                self.__round_state.set_zhenting(2 if self.__round_state.is_in_liqi() else 1)
+            self.__num_caught_up_decisions += 1
+            return None
+
+        start = time.perf_counter()
+        self.__num_decisions += 1
+        instrumented = self.__instrumentation is not None
+
+        decision = self.__decide_without_model(dapai, candidates)
+        if instrumented:
+            self.__observe("decide_without_model", start)
+        if decision is None:
+            result, fallback_reason = self.__infer(candidates, start)
+            if result is not None:
+                action, proportions = result
+                decision = candidates[action]
+                # 決定の内訳は DEBUG が有効な場合にのみ組み立てる．
+                logger.opt(lazy=True).debug(
+                    "Decision: {}",
+                    lambda: self.__format_decision(candidates, action, proportions, decision),
+                )
+            else:
+                if instrumented:
+                    t = time.perf_counter()
+                seat = self.__game_state.get_seat()
+                decision, policy = choose_fallback(self.__round_state, seat, candidates)
+                if instrumented:
+                    self.__observe("fallback", t)
+                self.__num_fallbacks += 1
+                logger.warning(
+                    "Fallback decision: {} (reason = {}, policy = {})",
+                    decision,
+                    fallback_reason,
+                    policy,
+                )
+        else:
+            self.__num_skipped_forward_passes += 1
+            self.__game_num_skipped_forward_passes += 1
+
+        if not instrumented:
+            return self.__decode(dapai, candidates, decision)
+        t = time.perf_counter()
+        ret = self.__decode(dapai, candidates, decision)
+        self.__observe("decode", t)
+        return ret
+
+    def __decode(self, dapai: Optional[int], candidates: List[int], decision: int) -> dict:
+        seat = self.__game_state.get_seat()
 
         if 0 <= decision <= 147:
             tile = decision // 4
@@ -1220,18 +1861,8 @@ class Kanachan:
         assert message["type"] == "tsumo"
 
         seat = self.__game_state.get_seat()
-
-        if "actor" not in message:
-            raise RuntimeError("A `tsumo` message without the `actor` key.")
         actor = message["actor"]
-        if actor < 0 or 4 <= actor:
-            raise RuntimeError(
-                f"A `tsumo` message with an invalid `actor` (actor = {actor})."
-            )
         mine = actor == seat
-
-        if "pai" not in message:
-            raise RuntimeError("A `tsumo` message without the `pai` key.")
         tile = message["pai"]
 
         my_score = self.__game_state.get_player_score(seat)
@@ -1243,9 +1874,9 @@ class Kanachan:
                 )
             self.__round_state.on_zimo(seat, mine, None, my_score)
         else:
-            if tile not in _TILE2NUM:
+            if tile == "?":
                 raise RuntimeError(
-                    f"A `tsumo` message with an invalid `pai` (seat = {seat}, actor = {actor}, pai = {tile})."
+                    f"An inconsistent `tsumo` message (seat = {seat}, actor = {actor}, pai = {tile})."
                 )
             tile = _TILE2NUM[tile]
             candidates = self.__round_state.on_zimo(seat, mine, tile, my_score)
@@ -1259,26 +1890,8 @@ class Kanachan:
         assert message["type"] == "dahai"
 
         seat = self.__game_state.get_seat()
-
-        if "actor" not in message:
-            raise RuntimeError("A `dahai` message without the `actor` key.")
         actor = message["actor"]
-        if actor < 0 or 4 <= actor:
-            raise RuntimeError(
-                f"A `dahai` message with an invalid `actor` (actor = {actor})."
-            )
-
-        if "pai" not in message:
-            raise RuntimeError("A `dahai` message without the `pai` key.")
-        tile = message["pai"]
-        if tile not in _TILE2NUM:
-            raise RuntimeError(
-                f"A `dahai` message with an invalid `pai` (pai = {tile})."
-            )
-        tile = _TILE2NUM[tile]
-
-        if "tsumogiri" not in message:
-            raise RuntimeError("A `dahai` message without the `tsumogiri` key.")
+        tile = _TILE2NUM[message["pai"]]
         moqi = message["tsumogiri"]
 
         candidates = self.__round_state.on_dapai(seat, actor, tile, moqi)
@@ -1301,41 +1914,10 @@ class Kanachan:
     def __on_chi(self, message: dict) -> dict:
         assert message["type"] == "chi"
 
-        if "actor" not in message:
-            raise RuntimeError("A `chi` message without the `actor` key.")
         actor = message["actor"]
-        if actor < 0 or 4 <= actor:
-            raise RuntimeError(
-                f"A `chi` message with an invalid `actor` (actor = {actor})."
-            )
         mine = actor == self.__game_state.get_seat()
-
-        if "target" not in message:
-            raise RuntimeError("A `chi` message without the `target` key.")
-        target = message["target"]
-        if target < 0 or 4 <= target:
-            raise RuntimeError(
-                f"A `chi` message with an invalid `target` (target = {target})."
-            )
-        if (target + 4 - actor) % 4 != 3:
-            raise RuntimeError(
-                f"An inconsistent `chi` message (actor = {actor}, target = {target})."
-            )
-
-        if "pai" not in message:
-            raise RuntimeError("A `chi` message without the `pai` key.")
         tile = message["pai"]
-        if tile not in _TILE2NUM:
-            raise RuntimeError(f"A `chi` message with an invalid `pai` (pai = {tile}).")
-
-        if "consumed" not in message:
-            raise RuntimeError("A `pon` message without the `consumed` key.")
         consumed = message["consumed"]
-        for t in consumed:
-            if t not in _TILE2NUM:
-                raise RuntimeError(
-                    f"A `chi` message with an invalid `consumed` (consumed = {consumed})."
-                )
 
         chi = (tile, tuple(consumed))
         if chi not in _CHI2NUM:
@@ -1360,42 +1942,11 @@ class Kanachan:
     def __on_peng(self, message: dict) -> dict:
         assert message["type"] == "pon"
 
-        if "actor" not in message:
-            raise RuntimeError("A `pon` message without the `actor` key.")
         actor = message["actor"]
-        if actor < 0 or 4 <= actor:
-            raise RuntimeError(
-                f"A `pon` message with an invalid `actor` (actor = {actor})."
-            )
         mine = actor == self.__game_state.get_seat()
-
-        if "target" not in message:
-            raise RuntimeError("A `pon` message without the `target` key.")
-        target = message["target"]
-        if target < 0 or 4 <= target:
-            raise RuntimeError(
-                f"A `pon` message with an invalid `target` (target = {target})."
-            )
-        if actor == target:
-            raise RuntimeError(
-                f"An inconsistent `pon` message (actor = {actor}, target = {target})."
-            )
-        relseat = (target + 4 - actor) % 4 - 1
-
-        if "pai" not in message:
-            raise RuntimeError("A `pon` message without the `pai` key.")
+        relseat = (message["target"] + 4 - actor) % 4 - 1
         tile = message["pai"]
-        if tile not in _TILE2NUM:
-            raise RuntimeError(f"A `pon` message with an invalid `pai` (pai = {tile}).")
-
-        if "consumed" not in message:
-            raise RuntimeError("A `pon` message without the `consumed` key.")
         consumed = message["consumed"]
-        for t in consumed:
-            if t not in _TILE2NUM:
-                raise RuntimeError(
-                    f"A `pon` message with an invalid `consumed` (consumed = {consumed})."
-                )
 
         peng = (tile, tuple(consumed))
         if peng not in _PENG2NUM:
@@ -1420,44 +1971,11 @@ class Kanachan:
     def __on_daminggang(self, message: dict) -> None:
         assert message["type"] == "daiminkan"
 
-        if "actor" not in message:
-            raise RuntimeError("A `daiminkan` message without the `actor` key.")
         actor = message["actor"]
-        if actor < 0 or 4 <= actor:
-            raise RuntimeError(
-                f"A `daiminkan` message with an invalid `actor` (actor = {actor})."
-            )
         mine = actor == self.__game_state.get_seat()
-
-        if "target" not in message:
-            raise RuntimeError("A `daiminkan` message without the `target` key.")
-        target = message["target"]
-        if target < 0 or 4 <= target:
-            raise RuntimeError(
-                f"A `daiminkan` message with an invalid `target` (target = {target})."
-            )
-        if actor == target:
-            raise RuntimeError(
-                f"An inconsistent `daiminkan` message (actor = {actor}, target = {target})."
-            )
-        relseat = (target + 4 - actor) % 4 - 1
-
-        if "pai" not in message:
-            raise RuntimeError("A `daiminkan` message without the `pai` key.")
+        relseat = (message["target"] + 4 - actor) % 4 - 1
         tile = message["pai"]
-        if tile not in _TILE2NUM:
-            raise RuntimeError(
-                f"A `daiminkan` message with an invalid `pai` (pai = {tile})."
-            )
-
-        if "consumed" not in message:
-            raise RuntimeError("A `daiminkan` message without the `consumed` key.")
         consumed = message["consumed"]
-        for t in consumed:
-            if t not in _TILE2NUM:
-                raise RuntimeError(
-                    f"A `daiminkan` message with an invalid `consumed` (consumed = {consumed})."
-                )
 
         daminggang = (tile, tuple(consumed))
         if daminggang not in _DAMINGGANG2NUM:
@@ -1470,18 +1988,8 @@ class Kanachan:
         assert message["type"] == "ankan"
 
         seat = self.__game_state.get_seat()
-
-        if "actor" not in message:
-            raise RuntimeError("A `ankan` message without the `actor` key.")
         actor = message["actor"]
-        if actor < 0 or 4 <= actor:
-            raise RuntimeError(
-                f"A `ankan` message with an invalid `actor` (actor = {actor})."
-            )
         mine = actor == seat
-
-        if "consumed" not in message:
-            raise RuntimeError("A `ankan` message without the `consumed` key.")
         consumed = message["consumed"]
         angang = tuple(consumed)
 
@@ -1510,28 +2018,9 @@ class Kanachan:
         assert message["type"] == "kakan"
 
         seat = self.__game_state.get_seat()
-
-        if "actor" not in message:
-            raise RuntimeError("A `kakan` message without the `actor` key.")
         actor = message["actor"]
-        if actor < 0 or 4 <= actor:
-            raise RuntimeError(
-                f"A `kakan` message with an invalid `actor` (actor = {actor})."
-            )
         mine = actor == seat
-
-        if "pai" not in message:
-            raise RuntimeError("A `kakan` message without the `pai` key.")
-        tile = message["pai"]
-        if tile not in _TILE2NUM:
-            raise RuntimeError(
-                f"A `kakan` message with an invalid `pai` (pai = {tile})."
-            )
-        tile = _TILE2NUM[tile]
-
-        if "consumed" not in message:
-            raise RuntimeError("A `kakan` message without the `consumed` key.")
-        consumed = message["consumed"]
+        tile = _TILE2NUM[message["pai"]]
 
         candidates = self.__round_state.on_jiagang(seat, actor, tile)
         if mine:
@@ -1551,26 +2040,14 @@ class Kanachan:
     def __on_liqi(self, message: dict) -> None:
         assert message["type"] == "reach"
 
-        if "actor" not in message:
-            raise RuntimeError("A `reach` message without the `actor` key.")
         actor = message["actor"]
-        if actor < 0 or 4 <= actor:
-            raise RuntimeError(
-                f"A `reach` message with an invalid `actor` (actor = {actor})."
-            )
 
         self.__round_state.on_liqi(actor)
 
     def __on_liqi_acceptance(self, message: dict) -> None:
         assert message["type"] == "reach_accepted"
 
-        if "actor" not in message:
-            raise RuntimeError("A `reach_accepted` message without the `actor` key.")
         actor = message["actor"]
-        if actor < 0 or 4 <= actor:
-            raise RuntimeError(
-                f"A `reach_accepted` message with an invalid `actor` (actor = {actor})."
-            )
         mine = actor == self.__game_state.get_seat()
 
         self.__game_state.on_liqi_acceptance(actor)
@@ -1579,44 +2056,13 @@ class Kanachan:
     def __on_new_dora(self, message: dict) -> None:
         assert message["type"] == "dora"
 
-        if "dora_marker" not in message:
-            raise RuntimeError("A `dora` message without the `dora_marker` key.")
-        dora_indicator = message["dora_marker"]
-        if dora_indicator not in _TILE2NUM:
-            raise RuntimeError(
-                f"A `dora` message with an invalid `dora_marker` (dora_marker = {dora_indicator})."
-            )
-        dora_indicator = _TILE2NUM[dora_indicator]
+        dora_indicator = _TILE2NUM[message["dora_marker"]]
 
         self.__round_state.on_new_dora(dora_indicator)
 
     def __on_hulu(self, message: dict) -> None:
         assert message["type"] == "hora"
 
-        if "actor" not in message:
-            raise RuntimeError("A `hora` message without the `actor` key.")
-        actor = message["actor"]
-        if actor < 0 or 4 <= actor:
-            raise RuntimeError(
-                f"A `hora` message with an invalid `actor` (actor = {actor})."
-            )
-
-        if "target" not in message:
-            raise RuntimeError("A `hora` message without the `target` key.")
-        target = message["target"]
-        if target < 0 or 4 <= target:
-            raise RuntimeError(
-                f"A `hora` message with an invalid `target` (target = {target})."
-            )
-
-        if "pai" not in message:
-            raise RuntimeError("A `hora` message without the `pai` key.")
-        tile = message["pai"]
-        if tile not in _TILE2NUM:
-            raise RuntimeError(
-                f"A `hora` message with an invalid `pai` (pai = {tile})."
-            )
-
     def __on_luju(self, message: dict) -> None:
         assert message["type"] == "ryukyoku"
 
@@ -1634,122 +2080,114 @@ class Kanachan:
 
     def __on_game_end(self, message: dict) -> dict:
         assert message["type"] == "end_game"
+        logger.info(
+            "Skipped forward passes in this game: {}", self.__game_num_skipped_forward_passes
+        )
         return {"type": "none"}
 
-    def run(self, messages: List[dict]) -> dict:
-        ret = None
-        while True:
-            if len(messages) == 0:
-                break
-            message = messages[0]
-            if "type" not in message:
-                raise RuntimeError("A message without the `type` key.")
-
-            if message["type"] == "hello":
-                if len(messages) > 1:
-                    raise RuntimeError("A multi-line `hello` message.")
-                assert ret is None
-                ret = self.__on_hello(message)
-                messages.pop(0)
-                continue
-
-            if message["type"] == "start_game":
-                if len(messages) != 1:
-                    raise RuntimeError("Too many messages starting with `start_game`.")
-                assert ret is None
-                ret = self.__on_start_game(message)
-                messages.pop(0)
-                continue
-
-            if message["type"] == "start_kyoku":
-                # if len(messages) < 2:
-                #     raise RuntimeError(
-                #         'Too few messages starting with `start_kyoku`.')
-                self.__on_start_kyoku(message)
-                messages.pop(0)
-                continue
-
-            if message["type"] == "tsumo":
-                assert ret is None
-                ret = self.__on_zimo(message)
-                messages.pop(0)
-                continue
-
-            if message["type"] == "dahai":
-                assert ret is None
-                ret = self.__on_dapai(message)
-                messages.pop(0)
-                continue
-
-            if message["type"] == "chi":
-                assert ret is None
-                ret = self.__on_chi(message)
-                messages.pop(0)
-                continue
-
-            if message["type"] == "pon":
-                assert ret is None
-                ret = self.__on_peng(message)
-                messages.pop(0)
-                continue
+    def __lookup(self, message: dict) -> tuple:
+        if "type" not in message:
+            raise RuntimeError("A message without the `type` key.")
+        entry = self.__dispatch_table.get(message["type"])
+        if entry is None:
+            raise RuntimeError(message)
+        if not self.__trusted:
+            if self.__instrumentation is None:
+                VALIDATORS[message["type"]](message)
+            else:
+                start = time.perf_counter()
+                VALIDATORS[message["type"]](message)
+                self.__instrumentation.observe(
+                    message["type"], "validate", time.perf_counter() - start
+                )
+        return entry
+
+    def __handle(self, handler, message: dict):
+        if self.__profiler is not None and self.__profiler.is_armed():
+            with self.__profiler.sample_thread():
+                return self.__handle_timed(handler, message)
+        return self.__handle_timed(handler, message)
+
+    def __handle_timed(self, handler, message: dict):
+        if self.__instrumentation is None:
+            return handler(message)
+        previous = self.__instrumentation.begin(message["type"])
+        start = time.perf_counter()
+        try:
+            return handler(message)
+        finally:
+            self.__instrumentation.observe(
+                message["type"], "handler", time.perf_counter() - start
+            )
+            self.__instrumentation.end(previous)
 
-            if message["type"] == "daiminkan":
-                self.__on_daminggang(message)
-                messages.pop(0)
-                continue
+    def __observe(self, stage: str, start: float) -> float:
+        now = time.perf_counter()
+        observe_current(stage, now - start)
+        return now
 
-            if message["type"] == "ankan":
-                assert ret is None
-                ret = self.__on_angang(message)
-                messages.pop(0)
-                continue
+    def feed(self, message: dict) -> Optional[dict]:
+        # 1つのメッセージを処理し，応答すべき決定がある場合にのみそれを返す．
+        handler, responds = self.__lookup(message)
+        ret = self.__handle(handler, message)
+        self.__on_processed()
+        return ret if responds else None
 
-            if message["type"] == "kakan":
+    def run(self, messages: List[dict]) -> dict:
+        ret = None
+        last = len(messages) - 1
+        for i, message in enumerate(messages):
+            handler, responds = self.__lookup(message)
+            if i != last and message["type"] in _LAST_MESSAGE_TYPES:
+                raise RuntimeError(_LAST_MESSAGE_TYPES[message["type"]])
+            if responds:
                 assert ret is None
-                ret = self.__on_jiagang(message)
-                messages.pop(0)
-                continue
-
-            if message["type"] == "reach":
-                self.__on_liqi(message)
-                messages.pop(0)
-                continue
-
-            if message["type"] == "reach_accepted":
-                self.__on_liqi_acceptance(message)
-                messages.pop(0)
-                continue
-
-            if message["type"] == "dora":
-                self.__on_new_dora(message)
-                messages.pop(0)
-                continue
-
-            if message["type"] == "hora":
-                self.__on_hulu(message)
-                messages.pop(0)
-                continue
-
-            if message["type"] == "ryukyoku":
-                self.__on_luju(message)
-                messages.pop(0)
-                continue
+                ret = self.__handle(handler, message)
+            else:
+                self.__handle(handler, message)
+        # 従来通り，処理したメッセージは `messages` から取り除く．
+        messages.clear()
+        self.__on_processed()
 
-            if message["type"] == "end_kyoku":
-                assert ret is None
-                ret = self.__on_round_end(message)
-                messages.pop(0)
-                continue
+        if ret is None:
+            return {"type": "none"}
 
-            if message["type"] == "end_game":
-                assert ret is None
-                ret = self.__on_game_end(message)
-                messages.pop(0)
-                if len(messages) > 0:
-                    raise RuntimeError("TODO: (A suitable error message)")
-                continue
+        return ret
 
-            raise RuntimeError(message)
+    def __caught_up_call(self) -> bool:
+        # 打牌に対して自分が和了または副露したかどうか．ダブロンでは他家の和了が
+        # 先に並ぶことがあるので，連続する `hora` を全て調べる．
+        seat = self.__game_state.get_seat()
+        for i in range(self.__catch_up_next, len(self.__catch_up_messages)):
+            message = self.__catch_up_messages[i]
+            if message.get("actor") == seat and message["type"] in (
+                "hora",
+                "chi",
+                "pon",
+                "daiminkan",
+            ):
+                return True
+            if message["type"] != "hora":
+                return False
+        return False
+
+    def catch_up(self, messages: List[dict]) -> dict:
+        # 再接続時などに再送された履歴をまとめて適用する．状態遷移は全ての
+        # メッセージについて行うが，推論は最後のメッセージに対してのみ行う．
+        if len(messages) == 0:
+            return {"type": "none"}
+        self.__catching_up = True
+        self.__catch_up_messages = messages
+        try:
+            for i, message in enumerate(messages[:-1]):
+                handler, responds = self.__lookup(message)
+                self.__catch_up_next = i + 1
+                self.__handle(handler, message)
+        finally:
+            self.__catching_up = False
+            self.__catch_up_messages = []
+        ret = self.feed(messages[-1])
+        messages.clear()
 
         if ret is None:
             return {"type": "none"}
@@ -0,0 +1,250 @@
+#!/usr/bin/env python3
+
+import argparse
+import copy
+import json
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import (
+    List,
+    Optional,
+)
+
+import torch
+from kanachan.constants import (
+    NUM_TYPES_OF_PROGRESSION_FEATURES,
+    NUM_TYPES_OF_ACTIONS,
+)
+
+
+def _pad_cat(tensors: List[torch.Tensor], value: int) -> torch.Tensor:
+    # 入力をバッチ内の最大長までパディングしてから連結する．`Kanachan` は
+    # バッチャと `bucketed_padding` の併用を拒むので，通常は全て同じ長さである．
+    length = max(t.size(1) for t in tensors)
+    return torch.cat(
+        [torch.nn.functional.pad(t, (0, length - t.size(1)), value=value) for t in tensors]
+    )
+
+
+class _Request:
+    def __init__(
+        self,
+        sparse: torch.Tensor,
+        numeric: torch.Tensor,
+        progression: torch.Tensor,
+        candidates: torch.Tensor,
+    ) -> None:
+        self.sparse = sparse
+        self.numeric = numeric
+        self.progression = progression
+        self.candidates = candidates
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+
+class InferenceBatcher:
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        *,
+        device: torch.device,
+        max_batch_size: int = 32,
+        max_delay: float = 0.002,
+    ) -> None:
+        if max_batch_size < 1:
+            raise RuntimeError(f"An invalid batch size (max_batch_size = {max_batch_size}).")
+        if max_delay < 0.0:
+            raise RuntimeError(f"An invalid delay (max_delay = {max_delay}).")
+        self.__model = model
+        self.__device = device
+        self.__max_batch_size = max_batch_size
+        self.__max_delay = max_delay
+        self.__queue = queue.Queue()
+        self.__num_batches = 0
+        self.__num_requests = 0
+        self.__closed = False
+        self.__thread = threading.Thread(
+            target=self.__loop, name="InferenceBatcher", daemon=True
+        )
+        self.__thread.start()
+
+    def get_device(self) -> torch.device:
+        return self.__device
+
+    def get_model_digest(self) -> Optional[str]:
+        # モデルが `kanachan_digest` を持たなければ `None` を返す．
+        return getattr(self.__model, "kanachan_digest", None)
+
+    def get_queue_depth(self) -> int:
+        return self.__queue.qsize()
+
+    def get_stats(self) -> dict:
+        return {
+            "batches": self.__num_batches,
+            "requests": self.__num_requests,
+            "mean_batch_size": (
+                self.__num_requests / self.__num_batches if self.__num_batches > 0 else 0.0
+            ),
+        }
+
+    def submit(
+        self,
+        sparse: torch.Tensor,
+        numeric: torch.Tensor,
+        progression: torch.Tensor,
+        candidates: torch.Tensor,
+    ) -> Future:
+        if self.__closed:
+            raise RuntimeError("A request is submitted to a closed `InferenceBatcher`.")
+        request = _Request(sparse, numeric, progression, candidates)
+        self.__queue.put(request)
+        return request.future
+
+    def infer(
+        self,
+        sparse: torch.Tensor,
+        numeric: torch.Tensor,
+        progression: torch.Tensor,
+        candidates: torch.Tensor,
+    ) -> tuple:
+        return self.submit(sparse, numeric, progression, candidates).result()
+
+    def close(self) -> None:
+        self.__closed = True
+        self.__queue.put(None)
+        self.__thread.join()
+
+    def __collect(self) -> Optional[List[_Request]]:
+        request = self.__queue.get()
+        if request is None:
+            return None
+        batch = [request]
+        # 最初のリクエストが投入されてから `max_delay` が経過するか，バッチが
+        # 満杯になるまで後続のリクエストを待つ．
+        deadline = request.enqueued_at + self.__max_delay
+        while len(batch) < self.__max_batch_size:
+            timeout = deadline - time.perf_counter()
+            try:
+                if timeout <= 0.0:
+                    request = self.__queue.get_nowait()
+                else:
+                    request = self.__queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if request is None:
+                # 終了要求は現在のバッチを処理した後で受け付ける．
+                self.__queue.put(None)
+                break
+            batch.append(request)
+        return batch
+
+    def __run(self, batch: List[_Request]) -> None:
+        with torch.no_grad():
+            sparse = torch.cat([r.sparse for r in batch]).to(device=self.__device)
+            numeric = torch.cat([r.numeric for r in batch]).to(device=self.__device)
+            progression = _pad_cat(
+                [r.progression for r in batch], NUM_TYPES_OF_PROGRESSION_FEATURES
+            ).to(device=self.__device)
+            candidates = _pad_cat(
+                [r.candidates for r in batch], NUM_TYPES_OF_ACTIONS
+            ).to(device=self.__device)
+            outputs = self.__model(sparse, numeric, progression, candidates)
+        for i, request in enumerate(batch):
+            request.future.set_result(tuple(output[i : i + 1] for output in outputs))
+
+    def __loop(self) -> None:
+        while True:
+            batch = self.__collect()
+            if batch is None:
+                break
+            try:
+                self.__run(batch)
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+            self.__num_batches += 1
+            self.__num_requests += len(batch)
+
+
+def _run_table(kanachan, games: List[tuple], latencies: List[float]) -> None:
+    from replay import split_messages
+
+    for seat, mjai_message_list in games:
+        for messages in split_messages(copy.deepcopy(mjai_message_list), seat):
+            num_decisions = kanachan.get_stats()["decisions"]
+            start = time.perf_counter()
+            kanachan.run(messages)
+            if kanachan.get_stats()["decisions"] != num_decisions:
+                latencies.append(time.perf_counter() - start)
+
+
+def main() -> None:
+    from log import add_logging_arguments, configure_logging_from_arguments
+
+    parser = argparse.ArgumentParser(
+        description="Replay majsoul records on many concurrent tables sharing one micro-batching scheduler."
+    )
+    parser.add_argument("--model", help="path to the model (default: the `Kanachan` default)")
+    parser.add_argument("--records", required=True, help="directory of majsoul records to replay")
+    parser.add_argument("--tables", type=int, default=50)
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-delay", type=float, default=0.002, help="seconds")
+    parser.add_argument("--device", default="cpu")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_arguments(args)
+
+    from _kanachan import (
+        DEFAULT_MODEL_PATH,
+        Kanachan,
+        load_kanachan_model,
+        resolve_device,
+    )
+    from convert_majsoul_to_mjai import parse_file
+    from replay import iter_record_files
+
+    device = resolve_device(args.device)
+    model_path = args.model if args.model is not None else DEFAULT_MODEL_PATH
+    model = load_kanachan_model(model_path, device, False)
+    batcher = InferenceBatcher(
+        model, device=device, max_batch_size=args.max_batch_size, max_delay=args.max_delay
+    )
+
+    games = [[] for _ in range(args.tables)]
+    for i, file_path in enumerate(iter_record_files(args.records)):
+        for seat in range(4):
+            games[i % args.tables].append(
+                (seat, parse_file(input_file_name=file_path, id=seat))
+            )
+
+    latencies = []
+    threads = []
+    for i in range(args.tables):
+        kanachan = Kanachan(batcher=batcher)
+        if i == 0:
+            kanachan.warmup()
+        thread = threading.Thread(target=_run_table, args=(kanachan, games[i], latencies))
+        threads.append(thread)
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    batcher.close()
+
+    latencies.sort()
+    report = batcher.get_stats()
+    report["decisions"] = len(latencies)
+    report["decisions_per_second"] = len(latencies) / elapsed
+    if len(latencies) > 0:
+        report["p50_seconds"] = latencies[len(latencies) // 2]
+        report["p99_seconds"] = latencies[min(len(latencies) * 99 // 100, len(latencies) - 1)]
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
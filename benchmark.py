@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import time
+from typing import (
+    List,
+    Optional,
+)
+
+from convert_majsoul_to_mjai import parse_file
+from log import add_logging_arguments, configure_logging_from_arguments
+from replay import iter_record_files, parse_options, split_messages
+
+# 推論に数える段階．それ以外の `Kanachan.run` の時間はルールの処理とする．
+# 期限切れで打ち切ったフォワードパスを待った時間も推論に数える．
+_INFERENCE_STAGES = ("encode", "decision_cache", "forward", "forward_abandoned")
+
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if len(sorted_values) == 0:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(q * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def _get_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            check=True,
+            text=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(games: List[tuple], options: dict, split: bool = True) -> dict:
+    import torch
+
+    from _kanachan import Kanachan
+    from instrumentation import Instrumentation
+
+    instrumentation = Instrumentation() if split else None
+    kanachan = Kanachan(instrumentation=instrumentation, **options)
+    warmup_report = kanachan.warmup()
+    if instrumentation is not None:
+        instrumentation.reset()
+
+    latencies = []
+    total_seconds = 0.0
+    for seat, mjai_message_list in games:
+        for messages in split_messages(mjai_message_list, seat):
+            num_decisions = kanachan.get_stats()["decisions"]
+            start = time.perf_counter()
+            kanachan.run(messages)
+            elapsed = time.perf_counter() - start
+            total_seconds += elapsed
+            if kanachan.get_stats()["decisions"] != num_decisions:
+                latencies.append(elapsed)
+    latencies.sort()
+
+    stats = kanachan.get_stats()
+    report = {
+        "revision": _get_revision(),
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "cpus": os.cpu_count(),
+        "options": options,
+        "warmup": warmup_report,
+        "games": len(games),
+        "decisions": len(latencies),
+        "forward_passes": stats["forward_passes"],
+        "seconds": total_seconds,
+        "decisions_per_second": len(latencies) / total_seconds if total_seconds > 0.0 else 0.0,
+        "latency_ms": {
+            "p50": _percentile(latencies, 0.50) * 1000.0,
+            "p95": _percentile(latencies, 0.95) * 1000.0,
+            "p99": _percentile(latencies, 0.99) * 1000.0,
+        },
+    }
+    if instrumentation is not None:
+        inference_seconds = sum(
+            histogram.sum
+            for (_, stage), histogram in instrumentation.get_histograms().items()
+            if stage in _INFERENCE_STAGES
+        )
+        report["split_seconds"] = {
+            "rule_logic": total_seconds - inference_seconds,
+            "inference": inference_seconds,
+        }
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measure end-to-end decisions/sec and decision latency over majsoul records."
+    )
+    parser.add_argument("--records", required=True, help="directory of majsoul records to replay")
+    parser.add_argument("--seats", type=int, nargs="+", default=[0, 1, 2, 3])
+    parser.add_argument(
+        "--options", nargs="*", default=[], metavar="KEY=VALUE",
+        help="`Kanachan` options (e.g. quantize=true device=cuda)",
+    )
+    parser.add_argument(
+        "--no-split",
+        action="store_true",
+        help="do not instrument the rule logic/inference split (lower overhead)",
+    )
+    parser.add_argument("--output", help="also write the report to this file")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_arguments(args)
+
+    # 変換は計測に含めない．
+    games = []
+    for file_path in iter_record_files(args.records):
+        for seat in args.seats:
+            games.append((seat, parse_file(input_file_name=file_path, id=seat)))
+    if len(games) == 0:
+        raise RuntimeError(f"No records found in {args.records}.")
+
+    report = run_benchmark(games, parse_options(args.options), split=not args.no_split)
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output is not None:
+        with open(args.output, mode="w", encoding="UTF-8") as f:
+            f.write(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import asyncio
+import json
+import struct
+from typing import Optional
+
+from constants import _TILE2NUM
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# 牌を表す文字列を `_TILE2NUM` のキーと同一のオブジェクトに置き換える．
+# 以降の `_TILE2NUM` の参照では文字列の比較が同一性の比較で済む．
+_INTERNED_TILES = {tile: tile for tile in _TILE2NUM}
+_INTERNED_TILES["?"] = "?"
+
+_TILE_KEYS = ("pai", "dora_marker")
+_TILE_LIST_KEYS = ("consumed",)
+
+_FRAME_HEADER_FORMAT = struct.Struct(">I")
+
+
+def intern_tiles(messages):
+    if isinstance(messages, dict):
+        _intern_message(messages)
+        return messages
+    for message in messages:
+        _intern_message(message)
+    return messages
+
+
+def _intern_message(message: dict) -> None:
+    interned = _INTERNED_TILES
+    for key in _TILE_KEYS:
+        tile = message.get(key)
+        if tile is not None:
+            message[key] = interned.get(tile, tile)
+    for key in _TILE_LIST_KEYS:
+        tiles = message.get(key)
+        if tiles is not None:
+            message[key] = [interned.get(tile, tile) for tile in tiles]
+    hands = message.get("tehais")
+    if hands is not None:
+        message["tehais"] = [[interned.get(tile, tile) for tile in hand] for hand in hands]
+
+
+class JsonCodec:
+    # 1行に1つの JSON 値を置く．`orjson` があればそれを使う．
+    def __init__(self) -> None:
+        self.name = "json" if orjson is None else "orjson"
+
+    def decode(self, data: bytes):
+        if orjson is not None:
+            return intern_tiles(orjson.loads(data))
+        return intern_tiles(json.loads(data))
+
+    def encode(self, value) -> bytes:
+        if orjson is not None:
+            return orjson.dumps(value) + b"\n"
+        return json.dumps(value, separators=(",", ":")).encode() + b"\n"
+
+    async def read(self, reader: asyncio.StreamReader) -> Optional[bytes]:
+        while True:
+            line = await reader.readline()
+            if len(line) == 0:
+                return None
+            line = line.strip()
+            if len(line) > 0:
+                return line
+
+
+class MsgpackCodec:
+    # 4バイトのビッグエンディアンの長さを前置した msgpack のフレーム．
+    # 信頼できるローカルな接続での利用を想定している．
+    def __init__(self) -> None:
+        if msgpack is None:
+            raise RuntimeError("`msgpack` is not installed.")
+        self.name = "msgpack"
+
+    def decode(self, data: bytes):
+        return intern_tiles(msgpack.unpackb(data))
+
+    def encode(self, value) -> bytes:
+        data = msgpack.packb(value)
+        return _FRAME_HEADER_FORMAT.pack(len(data)) + data
+
+    async def read(self, reader: asyncio.StreamReader) -> Optional[bytes]:
+        try:
+            header = await reader.readexactly(_FRAME_HEADER_FORMAT.size)
+        except asyncio.IncompleteReadError as e:
+            if len(e.partial) == 0:
+                return None
+            raise RuntimeError("A truncated frame header.") from e
+        (length,) = _FRAME_HEADER_FORMAT.unpack(header)
+        return await reader.readexactly(length)
+
+
+CODECS = {
+    "json": JsonCodec,
+    "msgpack": MsgpackCodec,
+}
+
+
+def get_codec(name: str):
+    if name not in CODECS:
+        raise RuntimeError(f"An unknown codec (name = {name}).")
+    return CODECS[name]()
@@ -0,0 +1,78 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+import torch
+
+
+class DecisionCache:
+    def __init__(self, max_entries: int = 65536) -> None:
+        if max_entries < 1:
+            raise RuntimeError(f"An invalid cache size (max_entries = {max_entries}).")
+        self.__max_entries = max_entries
+        self.__entries = OrderedDict()
+        self.__model_digest = None
+        # 複数のセッションで1つのキャッシュを共有できるようにする．
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+        self.__evictions = 0
+        self.__invalidations = 0
+
+    @staticmethod
+    def make_key(
+        sparse: torch.Tensor,
+        numeric: torch.Tensor,
+        progression: torch.Tensor,
+        candidates: torch.Tensor,
+    ) -> bytes:
+        h = hashlib.blake2b(digest_size=16)
+        for tensor in (sparse, numeric, progression, candidates):
+            tensor = tensor.detach().cpu().contiguous()
+            h.update(str(tuple(tensor.shape)).encode())
+            h.update(tensor.numpy().tobytes())
+        return h.digest()
+
+    def bind(self, model_digest: str) -> None:
+        # モデルが変わった場合，キャッシュされた決定は全て無効になる．
+        with self.__lock:
+            if self.__model_digest == model_digest:
+                return
+            if self.__model_digest is not None:
+                self.__invalidations += 1
+            self.__entries.clear()
+            self.__model_digest = model_digest
+
+    def get(self, key: bytes) -> Optional[tuple]:
+        with self.__lock:
+            value = self.__entries.get(key)
+            if value is None:
+                self.__misses += 1
+                return None
+            self.__entries.move_to_end(key)
+            self.__hits += 1
+        action, proportions = value
+        return action, proportions.clone()
+
+    def put(self, key: bytes, action: int, proportions: torch.Tensor) -> None:
+        value = (action, proportions.detach().cpu().clone())
+        with self.__lock:
+            self.__entries[key] = value
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.__max_entries:
+                self.__entries.popitem(last=False)
+                self.__evictions += 1
+
+    def get_metrics(self) -> dict:
+        with self.__lock:
+            lookups = self.__hits + self.__misses
+            return {
+                "entries": len(self.__entries),
+                "max_entries": self.__max_entries,
+                "hits": self.__hits,
+                "misses": self.__misses,
+                "hit_rate": self.__hits / lookups if lookups > 0 else 0.0,
+                "evictions": self.__evictions,
+                "invalidations": self.__invalidations,
+            }
@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+
+import argparse
+import copy
+import importlib
+import json
+import random
+import sys
+from collections import Counter
+from typing import (
+    Callable,
+    List,
+    Optional,
+)
+
+from constants import _NUM2TILE, _TILE34TILE37
+import hand_calculator
+from log import add_logging_arguments, configure_logging_from_arguments
+
+# 比較する関数．代替エンジンは同名の属性を持つモジュールとして与える．
+_FUNCTIONS = ("calculate_shanten", "has_yihan", "check_kokushi")
+
+# 候補のリストを返す `RoundState` のハンドラ．
+_CANDIDATE_METHODS = ("on_zimo", "on_dapai", "on_chi", "on_peng", "on_angang", "on_jiagang")
+
+# 么九牌の34種の番号．
+_YAOJIU = (0, 8, 9, 17, 18, 26, 27, 28, 29, 30, 31, 32, 33)
+
+
+def _format_hand(hand: List[int]) -> str:
+    return " ".join(_NUM2TILE[t] for t in sorted(hand))
+
+
+def _format_34(tiles_34: List[int]) -> str:
+    return " ".join(
+        _NUM2TILE[_TILE34TILE37[i]] for i, count in enumerate(tiles_34) for _ in range(count)
+    )
+
+
+def _call(function: Callable, args: tuple) -> tuple:
+    try:
+        return True, function(*args)
+    except Exception as e:
+        return False, f"{type(e).__name__}: {e}"
+
+
+def _raise(error: Exception) -> Callable:
+    def function(*args):
+        raise error
+
+    return function
+
+
+class DifferentialHarness:
+    def __init__(self, engine) -> None:
+        self.engine = engine
+        self.functions = [name for name in _FUNCTIONS if hasattr(engine, name)]
+        self.context = {}
+        self.comparisons = Counter()
+        self.num_divergences = 0
+        self.first_divergence = None
+
+    def compare(self, name: str, reference: Callable, alternative: Callable, args: tuple):
+        # 参照実装の結果をそのまま返す．参照実装の例外はそのまま送出する．
+        value = reference(*args)
+        self.comparisons[name] += 1
+        ok, alternative_value = _call(alternative, copy.deepcopy(args))
+        if not ok or alternative_value != value:
+            self.diverge(name, args, value, alternative_value)
+        return value
+
+    def diverge(self, name: str, args: tuple, reference_value, alternative_value) -> None:
+        self.num_divergences += 1
+        if self.first_divergence is not None:
+            return
+        divergence = {
+            "function": name,
+            "context": dict(self.context),
+            "reference": repr(reference_value),
+            "alternative": repr(alternative_value),
+        }
+        divergence.update(self.__reproduce(name, args))
+        self.first_divergence = divergence
+
+    def __reproduce(self, name: str, args: tuple) -> dict:
+        if name == "calculate_shanten":
+            tiles_34 = self.__minimize_34(list(args[0]), args[1:])
+            return {"args": [tiles_34, *args[1:]], "hand": _format_34(tiles_34)}
+        if name in ("has_yihan", "check_kokushi"):
+            chang, player_wind, hand, fulu_list, hupai, rong = args
+            return {
+                "args": [chang, player_wind, list(hand), list(fulu_list), hupai, rong],
+                "hand": _format_hand(hand),
+                "hupai": _NUM2TILE[hupai],
+            }
+        # `RoundState` の候補の不一致．その時点の手牌を示す．
+        round_state = self.context.get("round_state")
+        reproduction = {"args": repr(args)}
+        if round_state is not None:
+            reproduction["hand"] = _format_hand(round_state.get_my_hand())
+            zimo_tile = round_state.get_zimo_tile()
+            if zimo_tile is not None:
+                reproduction["zimo"] = _NUM2TILE[zimo_tile]
+            reproduction["fulu_list"] = list(round_state.get_my_fulu_list())
+        return reproduction
+
+    def __minimize_34(self, tiles_34: List[int], rest: tuple) -> List[int]:
+        # 不一致が再現する限り牌を1枚ずつ取り除く．
+        def diverges(candidate: List[int]) -> bool:
+            ok, reference_value = _call(hand_calculator.calculate_shanten, (candidate, *rest))
+            if not ok:
+                return False
+            ok, alternative_value = _call(self.engine.calculate_shanten, (candidate, *rest))
+            return ok and alternative_value != reference_value
+
+        changed = True
+        while changed:
+            changed = False
+            for i in range(34):
+                if tiles_34[i] == 0:
+                    continue
+                tiles_34[i] -= 1
+                if diverges(tiles_34):
+                    changed = True
+                else:
+                    tiles_34[i] += 1
+        return tiles_34
+
+    def make_round_state_class(self, reference_class, alternative_class):
+        harness = self
+
+        class DifferentialRoundState:
+            # 全ての呼び出しを両方の `RoundState` に転送し，参照実装の結果を返す．
+            def __init__(self) -> None:
+                self.reference = reference_class()
+                self.alternative = alternative_class()
+
+            def __getattr__(self, name: str):
+                reference = getattr(self.reference, name)
+                if not callable(reference):
+                    return reference
+                try:
+                    alternative = getattr(self.alternative, name)
+                except Exception as e:
+                    # 属性を持たないことも不一致として呼び出し時に報告する．
+                    alternative = _raise(e)
+                if name not in _CANDIDATE_METHODS:
+                    def forward(*args):
+                        ok, alternative_value = _call(alternative, copy.deepcopy(args))
+                        value = reference(*args)
+                        if not ok:
+                            # 状態を更新するだけのハンドラは，例外のみを不一致とする．
+                            harness.context["round_state"] = self.reference
+                            harness.diverge(f"RoundState.{name}", args, value, alternative_value)
+                        return value
+
+                    return forward
+
+                def compare(*args):
+                    harness.context["round_state"] = self.reference
+                    return harness.compare(f"RoundState.{name}", reference, alternative, args)
+
+                return compare
+
+        return DifferentialRoundState
+
+
+def _random_wall(rng: random.Random) -> List[int]:
+    # 赤牌を各色1枚ずつ含む136枚の牌山．
+    wall = []
+    for i in range(34):
+        for j in range(4):
+            tile = _TILE34TILE37[i]
+            if j == 0 and i < 27 and i % 9 == 4:
+                tile = (i // 9) * 10
+            wall.append(tile)
+    rng.shuffle(wall)
+    return wall
+
+
+def _to_34(tile: int) -> int:
+    if tile < 30:
+        return (tile // 10) * 9 + (((tile % 10) - 1) if (tile % 10 != 0) else 4)
+    return tile - 3
+
+
+def _take(wall: List[int], kind: int) -> Optional[int]:
+    for i, tile in enumerate(wall):
+        if _to_34(tile) == kind:
+            return wall.pop(i)
+    return None
+
+
+def _random_complete_hand(rng: random.Random) -> Optional[List[int]]:
+    # 4面子1雀頭の和了形を作る．牌が足りなければ `None` を返す．
+    wall = _random_wall(rng)
+    kinds = []
+    for _ in range(4):
+        if rng.random() < 0.5:
+            suit = rng.randrange(3)
+            first = suit * 9 + rng.randrange(7)
+            kinds += [first, first + 1, first + 2]
+        else:
+            kinds += [rng.randrange(34)] * 3
+    kinds += [rng.randrange(34)] * 2
+    hand = []
+    for kind in kinds:
+        tile = _take(wall, kind)
+        if tile is None:
+            return None
+        hand.append(tile)
+    return hand
+
+
+def _random_kokushi_hand(rng: random.Random) -> List[int]:
+    wall = _random_wall(rng)
+    kinds = list(_YAOJIU)
+    kinds.append(rng.choice(_YAOJIU))
+    if rng.random() < 0.3:
+        kinds[rng.randrange(13)] = rng.randrange(34)
+    return [_take(wall, kind) for kind in kinds]
+
+
+def _random_hands(rng: random.Random, n: int):
+    for _ in range(n):
+        r = rng.random()
+        hand = None
+        if r < 0.45:
+            hand = _random_complete_hand(rng)
+        elif r < 0.55:
+            hand = _random_kokushi_hand(rng)
+        if hand is None:
+            hand = _random_wall(rng)[:14]
+        rng.shuffle(hand)
+        if rng.random() < 0.3:
+            # 和了形の1枚を入れ替えて，聴牌や一向聴の形も混ぜる．
+            wall = [t for t in _random_wall(rng) if hand.count(t) == 0]
+            hand[rng.randrange(14)] = wall[0]
+        yield hand[:13], hand[13]
+
+
+def check_random_hands(harness: DifferentialHarness, n: int, seed: int) -> None:
+    rng = random.Random(seed)
+    for i, (hand, hupai) in enumerate(_random_hands(rng, n)):
+        harness.context = {"source": "random", "seed": seed, "iteration": i}
+        chang = rng.randrange(2)
+        player_wind = rng.randrange(4)
+        rong = rng.random() < 0.5
+        tiles_34 = [0] * 34
+        for tile in hand + [hupai]:
+            tiles_34[_to_34(tile)] += 1
+        # 役の判定は `RoundState` と同じく和了形に対してのみ行う．
+        complete = hand_calculator.calculate_shanten(tiles_34) == -1
+        for name in harness.functions:
+            if name == "calculate_shanten":
+                args = (tiles_34,)
+            elif complete:
+                args = (chang, player_wind, hand, [], hupai, rong)
+            else:
+                continue
+            ok, _ = _call(getattr(hand_calculator, name), args)
+            if not ok:
+                # 参照実装が受け付けない入力は比較しない．
+                continue
+            harness.compare(name, getattr(hand_calculator, name), getattr(harness.engine, name), args)
+        if harness.first_divergence is not None:
+            return
+
+
+def check_records(harness: DifferentialHarness, file_paths: List[str], seats: List[int]) -> None:
+    import _kanachan
+    from convert_majsoul_to_mjai import parse_file
+
+    # `_kanachan` の手牌の計算と `RoundState` を比較用のものに差し替えて，
+    # 牌譜を推論なしで再生する．
+    originals = {name: getattr(_kanachan, name) for name in _FUNCTIONS}
+    original_round_state = _kanachan.RoundState
+    try:
+        for name in harness.functions:
+            reference = originals[name]
+            alternative = getattr(harness.engine, name)
+            setattr(
+                _kanachan,
+                name,
+                lambda *args, name=name, reference=reference, alternative=alternative: (
+                    harness.compare(name, reference, alternative, args)
+                ),
+            )
+        if hasattr(harness.engine, "RoundState"):
+            _kanachan.RoundState = harness.make_round_state_class(
+                original_round_state, harness.engine.RoundState
+            )
+
+        for file_path in file_paths:
+            for seat in seats:
+                kanachan = _kanachan.Kanachan(trusted=True)
+                mjai_message_list = parse_file(input_file_name=file_path, id=seat)
+                for i, message in enumerate(mjai_message_list):
+                    harness.context = {
+                        "source": file_path,
+                        "seat": seat,
+                        "message_index": i,
+                        "message": json.dumps(message, ensure_ascii=False),
+                    }
+                    # 後続の `end_kyoku` は何もしないので，`message` は
+                    # 推論を伴わない追いつきモードで処理される．
+                    kanachan.catch_up([message, {"type": "end_kyoku"}])
+                    if harness.first_divergence is not None:
+                        return
+    finally:
+        for name, function in originals.items():
+            setattr(_kanachan, name, function)
+        _kanachan.RoundState = original_round_state
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Compare the hand calculations and `RoundState` candidates against an alternative engine."
+    )
+    parser.add_argument(
+        "--engine",
+        required=True,
+        help="module providing any of `calculate_shanten`, `has_yihan`, `check_kokushi` and `RoundState`",
+    )
+    parser.add_argument("--records", help="directory of majsoul records to replay")
+    parser.add_argument("--seats", type=int, nargs="+", default=[0, 1, 2, 3])
+    parser.add_argument("--random", type=int, default=10000, help="number of random hands")
+    parser.add_argument("--seed", type=int, default=0)
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_arguments(args)
+
+    harness = DifferentialHarness(importlib.import_module(args.engine))
+    if len(harness.functions) == 0 and not hasattr(harness.engine, "RoundState"):
+        raise RuntimeError(f"{args.engine} provides nothing to compare.")
+
+    if args.random > 0:
+        check_random_hands(harness, args.random, args.seed)
+    if args.records is not None and harness.first_divergence is None:
+        from replay import iter_record_files
+
+        check_records(harness, list(iter_record_files(args.records)), args.seats)
+
+    report = {
+        "engine": args.engine,
+        "comparisons": dict(harness.comparisons),
+        "divergences": harness.num_divergences,
+        "first_divergence": harness.first_divergence,
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if harness.first_divergence is not None:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
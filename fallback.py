@@ -0,0 +1,106 @@
+import sys
+from typing import (
+    List,
+    Optional,
+    Set,
+)
+
+from hand_calculator import calculate_shanten
+
+
+def _to_34(tile: int) -> int:
+    # 赤牌を含む37種の牌番号を34種の牌番号に変換する．
+    if tile < 30:
+        return (tile // 10) * 9 + (((tile % 10) - 1) if (tile % 10 != 0) else 4)
+    return tile - 3
+
+
+def _get_safe_tiles(round_state, seat: int) -> Optional[Set[int]]:
+    # 立直している全ての他家に対する現物 (立直者自身の捨て牌と，立直成立以降の
+    # 全員の捨て牌) を34種の牌番号で返す．他家が立直していなければ `None` を返す．
+    # 進行の立直フラグは自分の立直しか表さないので，`RoundState` が記録した
+    # 立直成立時の進行の長さを使う．
+    liqi_lengths = {
+        actor: length
+        for actor, length in enumerate(round_state.get_liqi_progression_lengths())
+        if length is not None and actor != seat
+    }
+    if len(liqi_lengths) == 0:
+        return None
+
+    safe_tiles = None
+    progression = round_state.copy_progression()
+    for liqi_actor, liqi_length in liqi_lengths.items():
+        tiles = set()
+        for i, p in enumerate(progression):
+            if p < 5 or 596 < p:
+                continue
+            encode = p - 5
+            actor = encode // 148
+            if actor == liqi_actor or i >= liqi_length:
+                tiles.add(_to_34((encode % 148) // 4))
+        safe_tiles = tiles if safe_tiles is None else safe_tiles & tiles
+    return safe_tiles
+
+
+def choose_fallback(round_state, seat: int, candidates: List[int]) -> tuple:
+    # モデルを使わずに，`RoundState` の情報のみから安価に決定を選ぶ．
+    # (decision, 選択理由) を返す．
+    for candidate in candidates:
+        if candidate == 219 or 543 <= candidate <= 545:
+            return candidate, "hora"
+
+    if 221 in candidates:
+        return 221, "decline"
+
+    discards = [c for c in candidates if 0 <= c <= 147 and c % 2 == 0]
+    if len(discards) == 0:
+        discards = [c for c in candidates if 0 <= c <= 147]
+    if len(discards) == 0:
+        return candidates[0], "first candidate"
+
+    hand = list(round_state.get_my_hand())
+    zimo_tile = round_state.get_zimo_tile()
+    if zimo_tile is not None:
+        hand.append(zimo_tile)
+
+    def get_shanten(discard: int) -> int:
+        new_hand = list(hand)
+        new_hand.remove(discard // 4)
+        return calculate_shanten(round_state.hand_to_34_array(new_hand))
+
+    safe_tiles = _get_safe_tiles(round_state, seat)
+    if safe_tiles is not None:
+        safe_discards = [c for c in discards if _to_34(c // 4) in safe_tiles]
+        if len(safe_discards) > 0:
+            return min(safe_discards, key=get_shanten), "genbutsu"
+
+    return min(discards, key=get_shanten), "lowest shanten"
+
+
+def check_genbutsu() -> tuple:
+    # 下家が2萬で立直した局面を再現し，手牌の2萬 (現物) が選ばれることを確かめる．
+    # 現物を考慮しなければ，向聴数の下がらない字牌が選ばれる局面である．
+    from _kanachan import RoundState
+
+    round_state = RoundState()
+    # 1萬2萬3萬 4筒5筒6筒 7索8索9索 5萬5萬 東南 (自分は0番の席)
+    round_state.on_new_round(0, 0, 0, 0, 1, [1, 2, 3, 14, 15, 16, 27, 28, 29, 5, 5, 30, 31])
+    round_state.on_zimo(0, False, None, 25000)
+    round_state.on_liqi(1)
+    round_state.on_dapai(0, 1, 2, False)
+    round_state.on_liqi_acceptance(False, 1)
+    # 西を自摸る．
+    candidates = round_state.on_zimo(0, True, 32, 24000)
+    return choose_fallback(round_state, 0, candidates)
+
+
+def main() -> None:
+    decision, reason = check_genbutsu()
+    print(f"decision = {decision}, reason = {reason}")
+    if reason != "genbutsu" or decision // 4 != 2:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 from typing import (
     List,
+    Optional,
 )
 
 from mahjong.hand_calculating.hand import HandCalculator as Impl
@@ -293,14 +294,11 @@ _TILE_OFFSET_RANGE = [
 ]
 
 
-def has_yihan(
-        chang: int,
-        player_wind: int,
+def _build_tiles_and_melds(
         hand: List[int],
         fulu_list: List[int],
         hupai: int,
-        rong: bool,
-) -> bool:
+) -> tuple:
     tiles = set()
     melds = []
 
@@ -376,6 +374,19 @@ def has_yihan(
     tiles = list(tiles)
     tiles.sort()
 
+    return tiles, melds
+
+
+def has_yihan(
+        chang: int,
+        player_wind: int,
+        hand: List[int],
+        fulu_list: List[int],
+        hupai: int,
+        rong: bool,
+) -> bool:
+    tiles, melds = _build_tiles_and_melds(hand, fulu_list, hupai)
+
     _hupai = _TILE_OFFSET_RANGE[hupai][0]
 
     options = OptionalRules(has_open_tanyao=True, has_aka_dora=True)
@@ -412,6 +423,52 @@ def has_yihan(
     return response.han >= 1
 
 
+def calculate_hora_cost(
+        chang: int,
+        player_wind: int,
+        hand: List[int],
+        fulu_list: List[int],
+        hupai: int,
+        rong: bool,
+        dora_indicators: List[int],
+        liqi: bool,
+) -> Optional[dict]:
+    tiles, melds = _build_tiles_and_melds(hand, fulu_list, hupai)
+
+    _hupai = _TILE_OFFSET_RANGE[hupai][0]
+    _dora_indicators = [_TILE_OFFSET_RANGE[t][0] for t in dora_indicators]
+
+    options = OptionalRules(has_open_tanyao=True, has_aka_dora=True)
+    config = HandConfig(
+        is_tsumo=not rong,
+        is_riichi=liqi,
+        player_wind=27 + player_wind,
+        round_wind=27 + chang,
+        options=options,
+    )
+    hand_calculator = Impl()
+
+    response = hand_calculator.estimate_hand_value(
+        tiles=tiles,
+        win_tile=_hupai,
+        melds=melds,
+        dora_indicators=_dora_indicators,
+        config=config,
+    )
+    if response.error is not None:
+        if (
+                response.error == "no_yaku"
+                or response.error == "There are no yaku in the hand"
+                or response.error == "Hand is not winning"
+        ):
+            return None
+        raise RuntimeError(response.error)
+
+    # 栄和の場合は `main` が放銃者の支払いである．自摸和の場合は `main` が親の
+    # 支払い， `additional` が子の支払いである (親の自摸和では両者は等しい)．
+    return response.cost
+
+
 def check_kokushi(
         chang: int,
         player_wind: int,
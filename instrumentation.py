@@ -0,0 +1,231 @@
+#!/usr/bin/env python3
+
+import argparse
+import bisect
+import copy
+import functools
+import json
+import threading
+import time
+from typing import (
+    Callable,
+    Optional,
+)
+
+# 各ヒストグラムで共通の，固定のバケット上限 (秒)．
+BUCKETS = (
+    1e-6, 2.5e-6, 5e-6,
+    1e-5, 2.5e-5, 5e-5,
+    1e-4, 2.5e-4, 5e-4,
+    1e-3, 2.5e-3, 5e-3,
+    1e-2, 2.5e-2, 5e-2,
+    1e-1, 2.5e-1, 5e-1,
+    1.0, 2.5, 5.0, 10.0,
+    float("inf"),
+)
+
+# 計装が有効な間，処理中のメッセージを (Instrumentation, メッセージの種類) で
+# スレッドごとに保持する．ラップされた関数の計測はこれに帰属させる．
+_current = threading.local()
+
+# ラップする関数と，その計測を記録する段階．
+_FUNCTIONS = (
+    ("calculate_shanten", "shanten"),
+    ("has_yihan", "has_yihan"),
+    ("check_kokushi", "kokushi"),
+)
+
+_install_lock = threading.Lock()
+# `install` の呼び出し回数から `uninstall` の呼び出し回数を引いたもの．
+_num_installs = 0
+_originals = None
+
+
+class Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def quantile(self, q: float) -> float:
+        # バケットの上限で近似した分位点．
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for upper, count in zip(BUCKETS, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return upper
+        return BUCKETS[-1]
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": [
+                ["+Inf" if upper == float("inf") else upper, count]
+                for upper, count in zip(BUCKETS, self.counts)
+            ],
+        }
+
+
+class Instrumentation:
+    def __init__(self) -> None:
+        # (メッセージの種類, 段階) -> Histogram
+        self.__histograms = {}
+        # 複数のセッションで1つの計装を共有できるようにする．
+        self.__lock = threading.Lock()
+
+    def observe(self, message_type: str, stage: str, seconds: float) -> None:
+        key = (message_type, stage)
+        with self.__lock:
+            histogram = self.__histograms.get(key)
+            if histogram is None:
+                histogram = Histogram()
+                self.__histograms[key] = histogram
+            histogram.observe(seconds)
+
+    def begin(self, message_type: str) -> Optional[tuple]:
+        previous = getattr(_current, "value", None)
+        _current.value = (self, message_type)
+        return previous
+
+    def end(self, previous: Optional[tuple]) -> None:
+        _current.value = previous
+
+    def get_histograms(self) -> dict:
+        with self.__lock:
+            return {key: _copy(histogram) for key, histogram in self.__histograms.items()}
+
+    def export(self) -> dict:
+        exported = {}
+        for (message_type, stage), histogram in sorted(self.get_histograms().items()):
+            exported.setdefault(message_type, {})[stage] = histogram.to_dict()
+        return exported
+
+    def to_json(self, indent: Optional[int] = 2) -> str:
+        return json.dumps(self.export(), indent=indent)
+
+    def reset(self) -> None:
+        with self.__lock:
+            self.__histograms.clear()
+
+
+def _copy(histogram: Histogram) -> Histogram:
+    copied = Histogram()
+    copied.counts = list(histogram.counts)
+    copied.count = histogram.count
+    copied.sum = histogram.sum
+    return copied
+
+
+def observe_current(stage: str, seconds: float) -> None:
+    current = getattr(_current, "value", None)
+    if current is not None:
+        current[0].observe(current[1], stage, seconds)
+
+
+def _wrap(function: Callable, stage: str) -> Callable:
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        current = getattr(_current, "value", None)
+        if current is None:
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            current[0].observe(current[1], stage, time.perf_counter() - start)
+
+    return wrapper
+
+
+def install() -> None:
+    # 手牌の計算と `RoundState.on_*` をプロセス全体でラップする．計装された
+    # `Kanachan` が存在する間だけラップし，最後の1つが `uninstall` を呼ぶと
+    # 元の関数に戻す．計装を使わないプロセスでは元の関数がそのまま使われる．
+    global _num_installs, _originals
+    with _install_lock:
+        _num_installs += 1
+        if _num_installs > 1:
+            return
+        import _kanachan
+        import fallback
+
+        _originals = {
+            "functions": {name: getattr(_kanachan, name) for name, _ in _FUNCTIONS},
+            "fallback": fallback.calculate_shanten,
+            "round_state": {
+                name: function
+                for name, function in vars(_kanachan.RoundState).items()
+                if name.startswith("on_")
+            },
+        }
+        for name, stage in _FUNCTIONS:
+            setattr(_kanachan, name, _wrap(getattr(_kanachan, name), stage))
+        fallback.calculate_shanten = _kanachan.calculate_shanten
+
+        round_state = _kanachan.RoundState
+        for name, function in _originals["round_state"].items():
+            setattr(round_state, name, _wrap(function, "round_state"))
+
+
+def uninstall() -> None:
+    global _num_installs, _originals
+    with _install_lock:
+        if _num_installs == 0:
+            return
+        _num_installs -= 1
+        if _num_installs > 0:
+            return
+        import _kanachan
+        import fallback
+
+        for name, function in _originals["functions"].items():
+            setattr(_kanachan, name, function)
+        fallback.calculate_shanten = _originals["fallback"]
+        for name, function in _originals["round_state"].items():
+            setattr(_kanachan.RoundState, name, function)
+        _originals = None
+
+
+def main() -> None:
+    from log import add_logging_arguments, configure_logging_from_arguments
+
+    parser = argparse.ArgumentParser(
+        description="Replay majsoul records with instrumentation enabled and export the stage histograms as JSON."
+    )
+    parser.add_argument("--records", required=True, help="majsoul record file or directory")
+    parser.add_argument("--seats", type=int, nargs="+", default=[0, 1, 2, 3])
+    parser.add_argument("--output", help="output file (default: stdout)")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_arguments(args)
+
+    from _kanachan import Kanachan
+    from convert_majsoul_to_mjai import parse_file
+    from replay import iter_record_files, split_messages
+
+    instrumentation = Instrumentation()
+    kanachan = Kanachan(instrumentation=instrumentation)
+    for file_path in iter_record_files(args.records):
+        for seat in args.seats:
+            mjai_message_list = parse_file(input_file_name=file_path, id=seat)
+            for messages in split_messages(copy.deepcopy(mjai_message_list), seat):
+                kanachan.run(messages)
+
+    if args.output is None:
+        print(instrumentation.to_json())
+    else:
+        with open(args.output, mode="w", encoding="UTF-8") as f:
+            f.write(instrumentation.to_json())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+import sys
+from typing import Optional
+
+from loguru import logger
+
+
+def configure_logging(
+    *,
+    level: str = "INFO",
+    path: Optional[str] = None,
+    rotation: str = "100 MB",
+    retention: int = 10,
+    compression: str = "gz",
+    serialize: bool = False,
+) -> None:
+    # 全てのシンクは `enqueue=True` で追加する．書き込みは別スレッドで行われ，
+    # 出力先が詰まっても応答を遅らせない．
+    logger.remove()
+    logger.add(sys.stderr, level=level, enqueue=True)
+    if path is not None:
+        logger.add(
+            path,
+            level=level,
+            enqueue=True,
+            rotation=rotation,
+            retention=retention,
+            compression=compression,
+            serialize=serialize,
+        )
+
+
+def add_logging_arguments(parser) -> None:
+    parser.add_argument("--log-level", default="INFO", help="minimum level of the logs")
+    parser.add_argument("--log-file", help="also write the logs to this rotated file")
+    parser.add_argument(
+        "--log-json", action="store_true", help="write the log file as JSON lines"
+    )
+
+
+def configure_logging_from_arguments(args) -> None:
+    configure_logging(level=args.log_level, path=args.log_file, serialize=args.log_json)
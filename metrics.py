@@ -0,0 +1,224 @@
+import os
+import socketserver
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from typing import Optional
+
+from decision_cache import DecisionCache
+from instrumentation import Histogram, Instrumentation
+from shared_model import memory_usage
+
+_QUANTILES = (0.5, 0.9, 0.99)
+
+
+def _format(value: float) -> str:
+    return "+Inf" if value == float("inf") else str(value)
+
+
+class Metrics:
+    def __init__(
+        self,
+        *,
+        instrumentation: Optional[Instrumentation] = None,
+        batcher=None,
+        decision_cache: Optional[DecisionCache] = None,
+        rate_window: int = 60,
+    ) -> None:
+        if rate_window < 1:
+            raise RuntimeError(f"An invalid rate window (rate_window = {rate_window}).")
+        # フォワードパスのレイテンシと手牌計算の呼び出し回数は
+        # `instrumentation` のヒストグラムから求める．
+        self.__instrumentation = instrumentation
+        self.__batcher = batcher
+        self.__decision_cache = decision_cache
+        self.__lock = threading.Lock()
+        self.__sessions = set()
+        # 終了したセッションの決定数．
+        self.__retired_decisions = 0
+        # 決定数/秒は，1秒ごとに記録した (時刻, 決定数) の直近 `rate_window` 秒分から
+        # プロセス内で求める．スクレイプによって状態が変わらないので，複数の
+        # スクレイパや再試行があっても値は影響を受けない．
+        self.__rate_window = rate_window
+        self.__samples = deque([(time.monotonic(), 0)], maxlen=rate_window + 1)
+        self.__closed = threading.Event()
+        self.__sampler = threading.Thread(
+            target=self.__sample, name="KanachanMetricsSampler", daemon=True
+        )
+        self.__sampler.start()
+
+    def __sample(self) -> None:
+        while not self.__closed.wait(1.0):
+            decisions, _ = self.__get_decisions()
+            with self.__lock:
+                self.__samples.append((time.monotonic(), decisions))
+
+    def close(self) -> None:
+        self.__closed.set()
+        self.__sampler.join()
+
+    def add_session(self, kanachan) -> None:
+        with self.__lock:
+            self.__sessions.add(kanachan)
+
+    def remove_session(self, kanachan) -> None:
+        decisions = kanachan.get_stats()["decisions"]
+        with self.__lock:
+            if kanachan in self.__sessions:
+                self.__sessions.remove(kanachan)
+                self.__retired_decisions += decisions
+
+    def __get_decisions(self) -> tuple:
+        with self.__lock:
+            sessions = list(self.__sessions)
+            retired = self.__retired_decisions
+        decisions = retired + sum(s.get_stats()["decisions"] for s in sessions)
+        return decisions, len(sessions)
+
+    def render(self) -> str:
+        lines = []
+
+        def metric(name: str, kind: str, help: str, samples) -> None:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, value in samples:
+                lines.append(f"{name}{labels} {value}")
+
+        decisions, num_sessions = self.__get_decisions()
+        now = time.monotonic()
+        with self.__lock:
+            oldest_time, oldest_decisions = self.__samples[0]
+        decisions_per_second = 0.0
+        if now > oldest_time:
+            decisions_per_second = (decisions - oldest_decisions) / (now - oldest_time)
+
+        metric("kanachan_decisions_total", "counter", "Decisions made.", [("", decisions)])
+        metric(
+            "kanachan_decisions_per_second",
+            "gauge",
+            f"Decisions per second over the last {self.__rate_window} seconds.",
+            [("", decisions_per_second)],
+        )
+        metric(
+            "kanachan_active_sessions", "gauge", "Sessions currently served.", [("", num_sessions)]
+        )
+
+        if self.__instrumentation is not None:
+            forward = Histogram()
+            calls = {"shanten": 0, "has_yihan": 0}
+            for (_, stage), histogram in self.__instrumentation.get_histograms().items():
+                if stage == "forward":
+                    forward.count += histogram.count
+                    forward.sum += histogram.sum
+                    for i, count in enumerate(histogram.counts):
+                        forward.counts[i] += count
+                elif stage in calls:
+                    calls[stage] += histogram.count
+            metric(
+                "kanachan_forward_seconds",
+                "summary",
+                "Forward pass latency (bucket upper bounds).",
+                [(f'{{quantile="{q}"}}', _format(forward.quantile(q))) for q in _QUANTILES],
+            )
+            lines.append(f"kanachan_forward_seconds_sum {forward.sum}")
+            lines.append(f"kanachan_forward_seconds_count {forward.count}")
+            for stage, count in calls.items():
+                metric(
+                    f"kanachan_{stage}_calls_per_decision",
+                    "gauge",
+                    f"Calls of `{stage}` per decision.",
+                    [("", count / decisions if decisions > 0 else 0.0)],
+                )
+
+        if self.__batcher is not None:
+            metric(
+                "kanachan_batcher_queue_depth",
+                "gauge",
+                "Requests waiting in the inference batcher.",
+                [("", self.__batcher.get_queue_depth())],
+            )
+
+        if self.__decision_cache is not None:
+            cache_metrics = self.__decision_cache.get_metrics()
+            metric(
+                "kanachan_decision_cache_hits_total",
+                "counter",
+                "Decisions answered from the decision cache.",
+                [("", cache_metrics["hits"])],
+            )
+            metric(
+                "kanachan_decision_cache_misses_total",
+                "counter",
+                "Decision cache lookups that required a forward pass.",
+                [("", cache_metrics["misses"])],
+            )
+            metric(
+                "kanachan_decision_cache_entries",
+                "gauge",
+                "Decisions held in the decision cache.",
+                [("", cache_metrics["entries"])],
+            )
+
+        try:
+            rss = memory_usage()["rss"]
+        except RuntimeError:
+            rss = None
+        if rss is not None:
+            metric(
+                "process_resident_memory_bytes", "gauge", "Resident set size.", [("", rss)]
+            )
+
+        return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self) -> None:
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.metrics.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+
+class _UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self) -> tuple:
+        # `BaseHTTPRequestHandler` はクライアントのアドレスを (host, port) とみなす．
+        request, _ = super().get_request()
+        return request, ("local", 0)
+
+
+class _TCPHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve_metrics(
+    metrics: Metrics,
+    *,
+    host: str = "127.0.0.1",
+    port: Optional[int] = None,
+    unix_path: Optional[str] = None,
+):
+    # `GET /metrics` に Prometheus のテキスト形式で応答するサーバを
+    # デーモンスレッドで起動する．
+    if unix_path is not None:
+        if os.path.exists(unix_path):
+            os.remove(unix_path)
+        server = _UnixHTTPServer(unix_path, _Handler)
+    else:
+        server = _TCPHTTPServer((host, port), _Handler)
+    server.metrics = metrics
+    thread = threading.Thread(
+        target=server.serve_forever, name="KanachanMetrics", daemon=True
+    )
+    thread.start()
+    return server
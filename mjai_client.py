@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import json
+import pathlib
+import sys
+import time
+from typing import List
+
+from codec import CODECS, get_codec
+from convert_majsoul_to_mjai import parse_file
+from replay import iter_record_files, split_messages
+
+
+async def _open_connection(args) -> tuple:
+    if args.unix is not None:
+        return await asyncio.open_unix_connection(args.unix), None
+    if args.tcp is not None:
+        host, port = args.tcp.rsplit(":", 1)
+        return await asyncio.open_connection(host, int(port)), None
+    # サーバを子プロセスとして起動し，パイプ越しに対局する．
+    server = pathlib.Path(__file__).parent / "server.py"
+    command = [sys.executable, str(server), "--stdio", "--codec", args.codec]
+    command += args.server_args
+    process = await asyncio.create_subprocess_exec(
+        *command, stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.PIPE
+    )
+    return (process.stdout, process.stdin), process
+
+
+async def play(args, seat: int, mjai_message_list: List[dict]) -> tuple:
+    # 1つの対局の記録を mjai クライアントの代わりに再生する．
+    (reader, writer), process = await _open_connection(args)
+    codec = get_codec(args.codec)
+    latencies = []
+    try:
+        for messages in split_messages(mjai_message_list, seat):
+            start = time.perf_counter()
+            writer.write(codec.encode(messages))
+            await writer.drain()
+            frame = await codec.read(reader)
+            if frame is None:
+                raise RuntimeError("The server closed the connection.")
+            latencies.append(time.perf_counter() - start)
+            if args.verbose:
+                print(f"seat {seat}: {codec.decode(frame)}")
+    finally:
+        writer.close()
+        if process is not None:
+            await process.wait()
+    return latencies
+
+
+async def run(args, games: List[tuple]) -> List[float]:
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def play_with_limit(seat, mjai_message_list):
+        async with semaphore:
+            return await play(args, seat, mjai_message_list)
+
+    results = await asyncio.gather(
+        *(play_with_limit(seat, mjai_message_list) for seat, mjai_message_list in games)
+    )
+    return [latency for latencies in results for latency in latencies]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Replay majsoul records against the mjai server as scripted clients."
+    )
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--tcp", metavar="HOST:PORT")
+    group.add_argument("--unix", metavar="PATH")
+    parser.add_argument("--records", required=True, help="majsoul record file or directory")
+    parser.add_argument("--seats", type=int, nargs="+", default=[0, 1, 2, 3])
+    parser.add_argument("--codec", choices=sorted(CODECS), default="json")
+    parser.add_argument("--concurrency", type=int, default=4, help="number of concurrent games")
+    parser.add_argument("--verbose", action="store_true", help="print every response")
+    parser.add_argument(
+        "server_args",
+        nargs=argparse.REMAINDER,
+        help="arguments for `server.py --stdio` when neither --tcp nor --unix is given",
+    )
+    args = parser.parse_args()
+
+    games = []
+    for file_path in iter_record_files(args.records):
+        for seat in args.seats:
+            games.append((seat, parse_file(input_file_name=file_path, id=seat)))
+    if len(games) == 0:
+        raise RuntimeError(f"No records found in {args.records}.")
+
+    start = time.perf_counter()
+    latencies = asyncio.run(run(args, games))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    summary = {
+        "games": len(games),
+        "requests": len(latencies),
+        "requests_per_second": len(latencies) / elapsed,
+    }
+    if len(latencies) > 0:
+        summary["p50_ms"] = latencies[len(latencies) // 2] * 1000.0
+        summary["p99_ms"] = latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1000.0
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
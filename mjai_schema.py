@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+import argparse
+import copy
+import json
+import time
+from typing import (
+    Callable,
+    Dict,
+    List,
+)
+
+from constants import _TILE2NUM
+from log import add_logging_arguments, configure_logging_from_arguments
+
+
+def _is_seat(value) -> bool:
+    return type(value) is int and 0 <= value < 4
+
+
+def _is_non_negative(value) -> bool:
+    return type(value) is int and value >= 0
+
+
+def _is_tile(value) -> bool:
+    # ハッシュできない値で `TypeError` が送出されないように，先に型を調べる．
+    return isinstance(value, str) and value in _TILE2NUM
+
+
+def _is_tile_or_unknown(value) -> bool:
+    return value == "?" or _is_tile(value)
+
+
+def _is_tiles(value) -> bool:
+    return isinstance(value, list) and all(_is_tile(t) for t in value)
+
+
+def _is_list(value) -> bool:
+    return isinstance(value, list)
+
+
+def _is_kyoku(value) -> bool:
+    return type(value) is int and 1 <= value <= 4
+
+
+def _is_scores(value) -> bool:
+    return isinstance(value, list) and len(value) == 4
+
+
+def _is_tehais(value) -> bool:
+    # 自身の手牌のみが公開され，他家の手牌は13枚の `?` である．
+    if not isinstance(value, list) or len(value) != 4:
+        return False
+    num_known = 0
+    for hand in value:
+        if not isinstance(hand, list) or len(hand) != 13:
+            return False
+        if hand.count("?") == 13:
+            continue
+        if not all(_is_tile(t) for t in hand):
+            return False
+        num_known += 1
+    return num_known == 1
+
+
+def _is_present(value) -> bool:
+    return True
+
+
+# メッセージの種類ごとに (キー, 検査) の列と，複数のキーにまたがる整合性の
+# 検査 (述語, 説明) の列を定める．
+_SCHEMAS = {
+    "hello": ((), ()),
+    "start_game": ((), ()),
+    "start_kyoku": (
+        (
+            ("bakaze", lambda value: value in ("E", "S", "W")),
+            ("kyoku", _is_kyoku),
+            ("honba", _is_non_negative),
+            ("kyotaku", _is_non_negative),
+            ("oya", _is_seat),
+            ("dora_marker", _is_tile),
+            ("scores", _is_scores),
+            ("tehais", _is_tehais),
+        ),
+        ((lambda m: m["oya"] == m["kyoku"] - 1, ("kyoku", "oya")),),
+    ),
+    "tsumo": ((("actor", _is_seat), ("pai", _is_tile_or_unknown)), ()),
+    "dahai": (
+        (("actor", _is_seat), ("pai", _is_tile), ("tsumogiri", _is_present)),
+        (),
+    ),
+    "chi": (
+        (
+            ("actor", _is_seat),
+            ("target", _is_seat),
+            ("pai", _is_tile),
+            ("consumed", _is_tiles),
+        ),
+        ((lambda m: (m["target"] + 4 - m["actor"]) % 4 == 3, ("actor", "target")),),
+    ),
+    "pon": (
+        (
+            ("actor", _is_seat),
+            ("target", _is_seat),
+            ("pai", _is_tile),
+            ("consumed", _is_tiles),
+        ),
+        ((lambda m: m["actor"] != m["target"], ("actor", "target")),),
+    ),
+    "daiminkan": (
+        (
+            ("actor", _is_seat),
+            ("target", _is_seat),
+            ("pai", _is_tile),
+            ("consumed", _is_tiles),
+        ),
+        ((lambda m: m["actor"] != m["target"], ("actor", "target")),),
+    ),
+    "ankan": ((("actor", _is_seat), ("consumed", _is_list)), ()),
+    "kakan": (
+        (("actor", _is_seat), ("pai", _is_tile), ("consumed", _is_list)),
+        (),
+    ),
+    "reach": ((("actor", _is_seat),), ()),
+    "reach_accepted": ((("actor", _is_seat),), ()),
+    "dora": ((("dora_marker", _is_tile),), ()),
+    "hora": (
+        (("actor", _is_seat), ("target", _is_seat), ("pai", _is_tile)),
+        (),
+    ),
+    "ryukyoku": ((), ()),
+    "end_kyoku": ((), ()),
+    "end_game": ((), ()),
+}
+
+
+def _compile(message_type: str, fields: tuple, consistencies: tuple) -> Callable:
+    # エラーメッセージの雛形は検査の前に組み立てておく．
+    fields = tuple(
+        (
+            key,
+            check,
+            f"A `{message_type}` message without the `{key}` key.",
+            f"A `{message_type}` message with an invalid `{key}` ({key} = {{}}).",
+        )
+        for key, check in fields
+    )
+    consistencies = tuple(
+        (
+            predicate,
+            keys,
+            f"An inconsistent `{message_type}` message ("
+            + ", ".join(f"{key} = {{}}" for key in keys)
+            + ").",
+        )
+        for predicate, keys in consistencies
+    )
+
+    def validate(message: dict) -> None:
+        for key, check, missing, invalid in fields:
+            if key not in message:
+                raise RuntimeError(missing)
+            value = message[key]
+            if not check(value):
+                raise RuntimeError(invalid.format(value))
+        for predicate, keys, inconsistent in consistencies:
+            if not predicate(message):
+                raise RuntimeError(inconsistent.format(*(message[key] for key in keys)))
+
+    return validate
+
+
+VALIDATORS: Dict[str, Callable] = {
+    message_type: _compile(message_type, fields, consistencies)
+    for message_type, (fields, consistencies) in _SCHEMAS.items()
+}
+
+
+def _measure(games: List[tuple], trusted: bool) -> dict:
+    from _kanachan import Kanachan
+
+    # 推論を伴わない `catch_up` で全てのイベントを流し込み，検証と状態遷移の
+    # コストのみを計測する．
+    kanachan = Kanachan(trusted=trusted)
+    num_events = 0
+    elapsed = 0.0
+    for _, mjai_message_list in games:
+        messages = copy.deepcopy(mjai_message_list)
+        num_events += len(messages)
+        start = time.perf_counter()
+        kanachan.catch_up(messages)
+        elapsed += time.perf_counter() - start
+    return {
+        "trusted": trusted,
+        "events": num_events,
+        "seconds": elapsed,
+        "events_per_second": num_events / elapsed if elapsed > 0.0 else 0.0,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Measure events/sec with and without message validation."
+    )
+    parser.add_argument("--records", required=True, help="majsoul record file or directory")
+    parser.add_argument("--seats", type=int, nargs="+", default=[0, 1, 2, 3])
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_arguments(args)
+
+    from convert_majsoul_to_mjai import parse_file
+    from replay import iter_record_files
+
+    games = []
+    for file_path in iter_record_files(args.records):
+        for seat in args.seats:
+            games.append((seat, parse_file(input_file_name=file_path, id=seat)))
+    if len(games) == 0:
+        raise RuntimeError(f"No records found in {args.records}.")
+
+    print(json.dumps([_measure(games, False), _measure(games, True)], indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import argparse
+import copy
+import hashlib
+import json
+import os
+import time
+from typing import Optional
+
+import torch
+
+_FORMAT_VERSION = 1
+
+# (パス, サイズ, 更新時刻) からハッシュ値へのメモ．
+_digests = {}
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, mode="rb") as f:
+        while True:
+            chunk = f.read(1 << 20)
+            if len(chunk) == 0:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def get_model_digest(model_path: str, cache_dir: Optional[str] = None) -> str:
+    stat = os.stat(model_path)
+    memo_key = (os.path.abspath(model_path), stat.st_size, stat.st_mtime_ns)
+    if memo_key in _digests:
+        return _digests[memo_key]
+
+    # 新しいキャッシュの記述子があれば，そこに記録されたハッシュ値を使う．
+    # `_is_fresh` と同じく，サイズと更新時刻の一致をもって新しいとみなす．
+    digest = None
+    descriptor_path = _get_cache_paths(model_path, cache_dir)[0]
+    if os.path.exists(descriptor_path):
+        with open(descriptor_path, encoding="UTF-8") as f:
+            descriptor = json.load(f)
+        if (
+            descriptor.get("format_version") == _FORMAT_VERSION
+            and descriptor["source_size"] == stat.st_size
+            and descriptor["source_mtime_ns"] == stat.st_mtime_ns
+        ):
+            digest = descriptor["source_sha256"]
+    if digest is None:
+        digest = file_digest(model_path)
+
+    _digests[memo_key] = digest
+    return digest
+
+
+def _get_cache_paths(model_path: str, cache_dir: Optional[str]) -> tuple:
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(model_path))
+    stem = os.path.join(cache_dir, os.path.basename(model_path))
+    # (descriptor, architecture, weights)
+    return f"{stem}.cache.json", f"{stem}.arch.pt", f"{stem}.weights.pt"
+
+
+def convert(model_path: str, cache_dir: Optional[str] = None) -> str:
+    from kanachan.model_loader import load_model
+
+    descriptor_path, architecture_path, weights_path = _get_cache_paths(
+        model_path, cache_dir
+    )
+    model = load_model(model_path, map_location="cpu")
+    model.to(dtype=torch.float32)
+
+    # 重みを含まないモジュールの骨組みをアーキテクチャ記述子として保存する．
+    # meta テンソルはデータを持たないので，このファイルは小さい．
+    architecture = copy.deepcopy(model).to(device="meta")
+    torch.save(architecture, architecture_path)
+    torch.save(model.state_dict(), weights_path)
+
+    stat = os.stat(model_path)
+    descriptor = {
+        "format_version": _FORMAT_VERSION,
+        "source": os.path.abspath(model_path),
+        "source_size": stat.st_size,
+        "source_mtime_ns": stat.st_mtime_ns,
+        "source_sha256": file_digest(model_path),
+    }
+    # 記述子は最後に書き込む．記述子が存在すれば，キャッシュは完全である．
+    with open(descriptor_path, mode="w", encoding="UTF-8") as f:
+        json.dump(descriptor, f, indent=2)
+    return descriptor_path
+
+
+def _is_fresh(model_path: str, descriptor: dict) -> bool:
+    if descriptor.get("format_version") != _FORMAT_VERSION:
+        return False
+    stat = os.stat(model_path)
+    if stat.st_size != descriptor["source_size"]:
+        return False
+    # 意図的な簡略化: サイズと更新時刻が一致すれば内容のハッシュを計算せずに
+    # 新しいとみなす．読み込みのたびにモデル全体をハッシュしないためである．
+    # 同じサイズの内容を更新時刻を保ったまま書き換えた場合は検出できず，
+    # 記述子のハッシュ値 (決定キャッシュの鍵にもなる) も古いまま使われる．
+    # そのような場合は `convert` でキャッシュを作り直すこと．
+    if stat.st_mtime_ns == descriptor["source_mtime_ns"]:
+        return True
+    # 更新時刻のみが変わった場合は内容のハッシュで判定する．
+    return file_digest(model_path) == descriptor["source_sha256"]
+
+
+def load_cached_model(
+    model_path: str, cache_dir: Optional[str] = None
+) -> Optional[torch.nn.Module]:
+    descriptor_path, architecture_path, weights_path = _get_cache_paths(
+        model_path, cache_dir
+    )
+    if not os.path.exists(descriptor_path):
+        return None
+    with open(descriptor_path, encoding="UTF-8") as f:
+        descriptor = json.load(f)
+    if not _is_fresh(model_path, descriptor):
+        return None
+
+    model = torch.load(architecture_path, map_location="meta")
+    # 重みはコピーせずにファイルを mmap したストレージをそのまま使う．
+    state_dict = torch.load(weights_path, map_location="cpu", mmap=True, weights_only=True)
+    model.load_state_dict(state_dict, assign=True)
+    model.eval()
+    return model
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Convert a `.kanachan` checkpoint into a memory-mappable model cache."
+    )
+    parser.add_argument("--model", help="path to the model (default: the `Kanachan` default)")
+    parser.add_argument("--cache-dir", help="directory of the cache (default: next to the model)")
+    args = parser.parse_args()
+
+    if args.model is None:
+        from _kanachan import DEFAULT_MODEL_PATH
+
+        model_path = DEFAULT_MODEL_PATH
+    else:
+        model_path = args.model
+
+    descriptor_path = convert(model_path, args.cache_dir)
+    print(f"Wrote the model cache described by {descriptor_path}.")
+
+    start = time.perf_counter()
+    load_cached_model(model_path, args.cache_dir)
+    print(f"Loaded the model cache in {time.perf_counter() - start:.3f} seconds.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import os
+import signal
+import sys
+import threading
+import time
+from collections import Counter
+from typing import (
+    Callable,
+    Optional,
+)
+
+import torch
+from loguru import logger
+
+
+class ProfilingCapture:
+    # `arm` (またはシグナル) で要求されると，次の `num_forward_passes` 回の
+    # フォワードパスを torch のプロファイラで記録し，同じ期間のハンドラの
+    # スタックを標本化する．記録を終えると Chrome trace と flamegraph 用の
+    # folded stacks を `output_dir` に書き出す．
+    def __init__(
+        self,
+        output_dir: str,
+        *,
+        num_forward_passes: int = 16,
+        sampling_interval: float = 0.001,
+    ) -> None:
+        if num_forward_passes < 1:
+            raise RuntimeError(
+                f"An invalid number of forward passes (num_forward_passes = {num_forward_passes})."
+            )
+        self.__output_dir = output_dir
+        self.__num_forward_passes = num_forward_passes
+        self.__sampling_interval = sampling_interval
+        # シグナルハンドラから書き込まれるのでロックを取らない．
+        self.__requested = 0
+        self.__lock = threading.Lock()
+        self.__active = False
+        self.__remaining = 0
+        self.__torch_profiler = None
+        self.__sampler = None
+        self.__sampled_threads = set()
+        self.__stacks = Counter()
+        self.__num_captures = 0
+
+    def arm(self, num_forward_passes: Optional[int] = None) -> None:
+        if num_forward_passes is None:
+            num_forward_passes = self.__num_forward_passes
+        self.__requested = num_forward_passes
+
+    def install_signal_handler(self, signum: int = signal.SIGUSR1) -> None:
+        signal.signal(signum, lambda signum, frame: self.arm())
+
+    def is_armed(self) -> bool:
+        return self.__requested > 0 or self.__active
+
+    def __start(self) -> None:
+        # `self.__lock` を保持した状態で呼ばれる．
+        if self.__active or self.__requested == 0:
+            return
+        self.__remaining = self.__requested
+        self.__requested = 0
+        self.__active = True
+        self.__stacks = Counter()
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self.__torch_profiler = torch.profiler.profile(
+            activities=activities, record_shapes=True
+        )
+        self.__torch_profiler.start()
+        self.__sampler = threading.Thread(
+            target=self.__sample, name="KanachanSampler", daemon=True
+        )
+        self.__sampler.start()
+
+    def __stop(self) -> None:
+        # `self.__lock` を保持した状態で呼ばれる．
+        self.__active = False
+        self.__torch_profiler.stop()
+        self.__sampler.join()
+        os.makedirs(self.__output_dir, exist_ok=True)
+        stem = os.path.join(
+            self.__output_dir, f"kanachan-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}"
+        )
+        self.__torch_profiler.export_chrome_trace(f"{stem}.trace.json")
+        with open(f"{stem}.folded", mode="w", encoding="UTF-8") as f:
+            for stack, count in self.__stacks.most_common():
+                f.write(f"{stack} {count}\n")
+        self.__torch_profiler = None
+        self.__sampler = None
+        self.__num_captures += 1
+        logger.info("Wrote a profiling capture to {}.trace.json and {}.folded", stem, stem)
+
+    def __sample(self) -> None:
+        while self.__active:
+            frames = sys._current_frames()
+            for thread_id in list(self.__sampled_threads):
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                    frame = frame.f_back
+                self.__stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.__sampling_interval)
+
+    @contextlib.contextmanager
+    def sample_thread(self):
+        # このブロックを実行している間，呼び出し元のスレッドを標本化する．
+        with self.__lock:
+            self.__start()
+        thread_id = threading.get_ident()
+        self.__sampled_threads.add(thread_id)
+        try:
+            yield
+        finally:
+            self.__sampled_threads.discard(thread_id)
+
+    def profile_forward(self, forward: Callable, *args):
+        with self.__lock:
+            self.__start()
+            active = self.__active
+        if not active:
+            return forward(*args)
+        with torch.profiler.record_function("kanachan_forward"):
+            result = forward(*args)
+        with self.__lock:
+            if self.__active:
+                self.__remaining -= 1
+                if self.__remaining == 0:
+                    self.__stop()
+        return result
+
+    def get_num_captures(self) -> int:
+        return self.__num_captures
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Trigger a profiling capture in a running bot by sending it a signal."
+    )
+    parser.add_argument("pid", type=int, help="process started with `--profile-dir`")
+    args = parser.parse_args()
+    os.kill(args.pid, signal.SIGUSR1)
+
+
+if __name__ == "__main__":
+    main()
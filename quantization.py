@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import sys
+from typing import List
+
+import torch
+
+# `Kanachan` はこの拡張子を持つモデルを量子化済みのモデルとして読み込む．
+QUANTIZED_MODEL_SUFFIX = ".int8.pt"
+
+
+def quantize_model(model: torch.nn.Module) -> torch.nn.Module:
+    # 動的量子化は CPU 上の float32 モデルに対してのみ適用できる．
+    model = model.to(device="cpu", dtype=torch.float32)
+    model.eval()
+    # `torch.nn.MultiheadAttention` の射影は動的量子化の対象にならないので，
+    # feedforward 層などの `torch.nn.Linear` のみが量子化される．
+    return torch.ao.quantization.quantize_dynamic(
+        model, {torch.nn.Linear}, dtype=torch.qint8
+    )
+
+
+def save_quantized_model(model: torch.nn.Module, path: str) -> None:
+    if not path.endswith(QUANTIZED_MODEL_SUFFIX):
+        raise RuntimeError(
+            f"A quantized model path must end with `{QUANTIZED_MODEL_SUFFIX}` (path = {path})."
+        )
+    torch.save(model, path)
+
+
+def load_quantized_model(path: str) -> torch.nn.Module:
+    model = torch.load(path, map_location="cpu")
+    model.eval()
+    return model
+
+
+def _get_model_size(model: torch.nn.Module) -> int:
+    size = 0
+    for tensor in model.state_dict().values():
+        if isinstance(tensor, torch.Tensor):
+            size += tensor.numel() * tensor.element_size()
+    return size
+
+
+def report_agreement(
+    *, model_path: str, quantized_model_path: str, file_paths: List[str], seats: List[int]
+) -> dict:
+    from _kanachan import Kanachan
+    from replay import compare_decisions
+
+    reference = Kanachan(model_path)
+    candidate = Kanachan(quantized_model_path)
+    reference.warmup()
+    candidate.warmup()
+
+    report = compare_decisions(reference, candidate, file_paths, seats)
+    report["fp32_model_bytes"] = os.path.getsize(model_path)
+    report["int8_model_bytes"] = os.path.getsize(quantized_model_path)
+
+    num_decisions = max(report["decisions"], 1)
+    report["fp32_seconds_per_decision"] = report.pop("reference_seconds") / num_decisions
+    report["int8_seconds_per_decision"] = report.pop("candidate_seconds") / num_decisions
+    return report
+
+
+def main() -> None:
+    from log import add_logging_arguments, configure_logging_from_arguments
+
+    parser = argparse.ArgumentParser(
+        description="Quantize a Kanachan model to int8 and report its agreement with the fp32 model."
+    )
+    parser.add_argument("--model", required=True, help="path to the fp32 `.kanachan` model")
+    parser.add_argument(
+        "--output", help=f"path to the quantized model (default: <model>{QUANTIZED_MODEL_SUFFIX})"
+    )
+    parser.add_argument("--records", help="directory of majsoul records to replay")
+    parser.add_argument("--seats", type=int, nargs="+", default=[0, 1, 2, 3])
+    parser.add_argument(
+        "--min-agreement",
+        type=float,
+        default=0.0,
+        help="exit with an error if the top-1 agreement is below this rate",
+    )
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_arguments(args)
+
+    from kanachan.model_loader import load_model
+    from replay import iter_record_files
+
+    output = args.output
+    if output is None:
+        output = os.path.splitext(args.model)[0] + QUANTIZED_MODEL_SUFFIX
+
+    model = load_model(args.model, map_location="cpu")
+    fp32_size = _get_model_size(model)
+    quantized_model = quantize_model(model)
+    save_quantized_model(quantized_model, output)
+    print(
+        f"Saved the quantized model to {output} "
+        f"(fp32 parameters = {fp32_size} bytes, int8 file = {os.path.getsize(output)} bytes)."
+    )
+
+    if args.records is None:
+        return
+
+    report = report_agreement(
+        model_path=args.model,
+        quantized_model_path=output,
+        file_paths=list(iter_record_files(args.records)),
+        seats=args.seats,
+    )
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if report["agreement_rate"] < args.min_agreement:
+        print(
+            f"The top-1 agreement {report['agreement_rate']:.4f} is below {args.min_agreement:.4f}.",
+            file=sys.stderr,
+        )
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
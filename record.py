@@ -1,16 +1,26 @@
-from os import walk
-from os.path import join
-from sys import exit
+import argparse
+import json
+import multiprocessing
+import time
+from collections import Counter
+from typing import (
+    List,
+    Optional,
+)
+
+from loguru import logger
 
 from _kanachan import Kanachan
 from convert_majsoul_to_mjai import parse_file
+from log import add_logging_arguments, configure_logging, configure_logging_from_arguments
+from replay import iter_record_files, parse_options, split_messages
 
-mjai_message_sub_list = []
+# ワーカープロセスごとに1つだけ作られ，全ての牌譜で使い回される．
+# `start_game` で対局と局の状態は初期化されるが，モデルはそのまま残る．
+_shared_kanachan = None
 
 
-def process_messages(kanachan, messages: list[dict]):
-    global mjai_message_sub_list
-
+def process_messages(kanachan, messages: list[dict], mjai_message_sub_list: list[dict]):
     for message in messages:
         mjai_message_sub_list.append(message)
     result = kanachan.run(messages)
@@ -19,64 +29,150 @@ def process_messages(kanachan, messages: list[dict]):
         raise RuntimeError(f"kanachan error {result}")
 
     if result["type"] == "none":
-        return
+        return None
 
-    print(f"mjai_message_sub_list: {mjai_message_sub_list}")
+    # メッセージ列全体の整形は DEBUG が有効な場合にのみ行われる．
+    logger.debug("mjai_message_sub_list: {}", mjai_message_sub_list)
     mjai_message_sub_list.clear()
-    print(f"kanachan: {result}")
-
+    logger.info("kanachan: {}", result)
+    return result
 
-def traverse_directory(path):
-    for root, directories, files in walk(path):
-        for file in files:
-            file_path = join(root, file)
-            # 在这里对每个文件执行你想要的操作
-            print(f"reviewer_records file={file} id=0")
-            reviewer_records(input_file_name=file_path, id=0)
-            # print(f"reviewer_records file={file} id=1")
-            # reviewer_records(input_file_name=file_path, id=1)
-            # print(f"reviewer_records file={file} id=2")
-            # reviewer_records(input_file_name=file_path, id=2)
-            # print(f"reviewer_records file={file} id=3")
-            # reviewer_records(input_file_name=file_path, id=3)
-            exit(0)
 
-
-def reviewer_records(*, input_file_name: str, id: int):
-    kanachan = Kanachan()
+def reviewer_records(*, input_file_name: str, id: int) -> List[dict]:
+    global _shared_kanachan
+    if _shared_kanachan is None:
+        _shared_kanachan = Kanachan()
+    kanachan = _shared_kanachan
 
     mjai_message_list = parse_file(input_file_name=input_file_name, id=id)
 
+    results = []
     mjai_message_sub_list = []
-    for mjai_message in mjai_message_list:
-        if "type" not in mjai_message:
-            raise Exception(f"mjai_message.type not in mjai_message: {mjai_message}")
-
-        type = mjai_message["type"]
-        actor_is_id = mjai_message.get("actor") == id
-
-        # Define a set of message types that should trigger processing
-        process_types = {"start_game", "dahai", "end_kyoku"}
-
-        # Define a set of message types that should also consider the actor ID
-        actor_specific_types = {
-            "tsumo",
-            "pon",
-            "chi",
-            "kakan",
-            "daiminkan",
-            "ankan",
-            "reach",
-        }
-
-        mjai_message_sub_list.append(mjai_message)
-
-        # Check if the current message type is in the process types or is actor-specific and matches the ID
-        if type in process_types or (type in actor_specific_types and actor_is_id):
-            process_messages(kanachan, mjai_message_sub_list)
-            mjai_message_sub_list = []
+    for messages in split_messages(mjai_message_list, id):
+        result = process_messages(kanachan, messages, mjai_message_sub_list)
+        if result is not None:
+            results.append(result)
+    return results
+
+
+def _init_worker(options: dict, log_level: str) -> None:
+    global _shared_kanachan
+    from _kanachan import DEFAULT_MODEL_PATH, configure_runtime, load_kanachan_model, resolve_device
+
+    configure_logging(level=log_level)
+    options = dict(options)
+    # 各ワーカーは1つのコアを使い，コア数に対してほぼ線形に伸びるようにする．
+    # `Kanachan` にも渡して `game.json` の設定で上書きされないようにする．
+    options.setdefault("num_threads", 1)
+    options.setdefault("num_interop_threads", 1)
+    configure_runtime(
+        num_threads=options["num_threads"],
+        num_interop_threads=options["num_interop_threads"],
+        cpu_affinity=options.get("cpu_affinity"),
+    )
+    model_path = options.pop("model_path", DEFAULT_MODEL_PATH)
+    device = resolve_device(options.pop("device", "cpu"))
+    model = load_kanachan_model(model_path, device, options.pop("quantize", False))
+    _shared_kanachan = Kanachan(model=model, **options)
+
+
+def _review_file(task: tuple) -> dict:
+    file_path, seats = task
+    start = time.perf_counter()
+    summary = {"file": file_path, "seats": {}}
+    try:
+        for seat in seats:
+            results = reviewer_records(input_file_name=file_path, id=seat)
+            summary["seats"][seat] = {
+                "decisions": len(results),
+                "types": dict(Counter(result["type"] for result in results)),
+                "results": results,
+            }
+    except Exception as e:
+        summary["error"] = f"{type(e).__name__}: {e}"
+    summary["seconds"] = time.perf_counter() - start
+    return summary
+
+
+def traverse_directory(
+    path: str,
+    *,
+    seats: List[int],
+    num_workers: int,
+    options: Optional[dict] = None,
+    output: Optional[str] = None,
+    log_level: str = "INFO",
+) -> dict:
+    # ファイル単位でワーカーに分配する．各ワーカーはモデルを1度だけ読み込む．
+    tasks = [(file_path, seats) for file_path in iter_record_files(path)]
+    context = multiprocessing.get_context("spawn")
+    start = time.perf_counter()
+    num_decisions = 0
+    types = Counter()
+    failed_files = []
+    output_file = open(output, mode="w", encoding="UTF-8") if output is not None else None
+    try:
+        with context.Pool(
+            num_workers, initializer=_init_worker, initargs=(options or {}, log_level)
+        ) as pool:
+            for summary in pool.imap_unordered(_review_file, tasks):
+                if "error" in summary:
+                    failed_files.append({"file": summary["file"], "error": summary["error"]})
+                    logger.error("Failed to review {}: {}", summary["file"], summary["error"])
+                for seat_summary in summary["seats"].values():
+                    num_decisions += seat_summary["decisions"]
+                    types.update(seat_summary["types"])
+                if output_file is not None:
+                    output_file.write(json.dumps(summary, ensure_ascii=False) + "\n")
+                logger.info(
+                    "reviewer_records file={} seats={} seconds={:.3f}",
+                    summary["file"],
+                    list(summary["seats"]),
+                    summary["seconds"],
+                )
+    finally:
+        if output_file is not None:
+            output_file.close()
+    elapsed = time.perf_counter() - start
+
+    return {
+        "files": len(tasks),
+        "failed_files": failed_files,
+        "seats": seats,
+        "workers": num_workers,
+        "decisions": num_decisions,
+        "types": dict(types),
+        "seconds": elapsed,
+        "decisions_per_second": num_decisions / elapsed if elapsed > 0.0 else 0.0,
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Review majsoul records in parallel.")
+    parser.add_argument("--records", default="G:\\majsoul\\record-data")
+    parser.add_argument("--seats", type=int, nargs="+", default=[0, 1, 2, 3])
+    parser.add_argument(
+        "--workers", type=int, default=multiprocessing.cpu_count(), help="number of processes"
+    )
+    parser.add_argument(
+        "--options", nargs="*", default=[], metavar="KEY=VALUE",
+        help="model and `Kanachan` options (e.g. quantize=true num_threads=1)",
+    )
+    parser.add_argument("--output", help="write the per-file results as JSON lines")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+
+    configure_logging_from_arguments(args)
+    report = traverse_directory(
+        args.records,
+        seats=args.seats,
+        num_workers=args.workers,
+        options=parse_options(args.options),
+        output=args.output,
+        log_level=args.log_level,
+    )
+    print(json.dumps(report, indent=2))
 
 
 if __name__ == "__main__":
-    traverse_directory(path="G:\\majsoul\\record-data")
-    exit(0)
+    main()
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import argparse
+import copy
+import json
+import sys
+import time
+from os import walk
+from os.path import isfile, join
+from typing import (
+    Iterator,
+    List,
+)
+
+from convert_majsoul_to_mjai import parse_file
+from log import add_logging_arguments, configure_logging_from_arguments
+
+# Message types that end a sub-list regardless of the actor.
+_PROCESS_TYPES = {"start_game", "dahai", "end_kyoku"}
+
+# Message types that end a sub-list only when the actor is the reviewed seat.
+_ACTOR_SPECIFIC_TYPES = {
+    "tsumo",
+    "pon",
+    "chi",
+    "kakan",
+    "daiminkan",
+    "ankan",
+    "reach",
+}
+
+
+def iter_record_files(path: str) -> Iterator[str]:
+    # A single record file is accepted as well as a directory of records.
+    if isfile(path):
+        yield path
+        return
+    for root, directories, files in walk(path):
+        for file in sorted(files):
+            yield join(root, file)
+
+
+def split_messages(mjai_message_list: List[dict], id: int) -> Iterator[List[dict]]:
+    mjai_message_sub_list = []
+    for mjai_message in mjai_message_list:
+        if "type" not in mjai_message:
+            raise Exception(f"mjai_message.type not in mjai_message: {mjai_message}")
+
+        type = mjai_message["type"]
+        actor_is_id = mjai_message.get("actor") == id
+
+        mjai_message_sub_list.append(mjai_message)
+
+        if type in _PROCESS_TYPES or (type in _ACTOR_SPECIFIC_TYPES and actor_is_id):
+            yield mjai_message_sub_list
+            mjai_message_sub_list = []
+
+
+def compare_decisions(reference, candidate, file_paths: List[str], seats: List[int]) -> dict:
+    # `reference` と `candidate` は同じメッセージ列を受け取るが，`Kanachan.run` は
+    # メッセージを書き換えるので，それぞれに別のコピーを渡す．
+    num_decisions = 0
+    num_agreements = 0
+    first_disagreement = None
+    reference_seconds = 0.0
+    candidate_seconds = 0.0
+    for file_path in file_paths:
+        for seat in seats:
+            mjai_message_list = parse_file(input_file_name=file_path, id=seat)
+            for messages in split_messages(mjai_message_list, seat):
+                num_reference_decisions = reference.get_stats()["decisions"]
+                reference_messages = copy.deepcopy(messages)
+                candidate_messages = copy.deepcopy(messages)
+                start = time.perf_counter()
+                reference_result = reference.run(reference_messages)
+                middle = time.perf_counter()
+                candidate_result = candidate.run(candidate_messages)
+                end = time.perf_counter()
+                if reference.get_stats()["decisions"] == num_reference_decisions:
+                    continue
+                num_decisions += 1
+                reference_seconds += middle - start
+                candidate_seconds += end - middle
+                if reference_result == candidate_result:
+                    num_agreements += 1
+                elif first_disagreement is None:
+                    first_disagreement = {
+                        "file": file_path,
+                        "seat": seat,
+                        "messages": messages,
+                        "reference": reference_result,
+                        "candidate": candidate_result,
+                    }
+
+    return {
+        "decisions": num_decisions,
+        "agreements": num_agreements,
+        "agreement_rate": num_agreements / num_decisions if num_decisions > 0 else 1.0,
+        "reference_seconds": reference_seconds,
+        "candidate_seconds": candidate_seconds,
+        "first_disagreement": first_disagreement,
+    }
+
+
+def parse_options(options: List[str]) -> dict:
+    # `key=value` の value は JSON として解釈する．解釈できなければ文字列とする．
+    parsed = {}
+    for option in options:
+        if "=" not in option:
+            raise RuntimeError(f"An invalid option (option = {option}), want `key=value`.")
+        key, value = option.split("=", 1)
+        try:
+            parsed[key] = json.loads(value)
+        except json.JSONDecodeError:
+            parsed[key] = value
+    return parsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Replay majsoul records through two differently configured `Kanachan` instances and compare their decisions."
+    )
+    parser.add_argument("--records", required=True, help="directory of majsoul records to replay")
+    parser.add_argument("--seats", type=int, nargs="+", default=[0, 1, 2, 3])
+    parser.add_argument(
+        "--reference", nargs="*", default=[], metavar="KEY=VALUE",
+        help="`Kanachan` options of the reference instance",
+    )
+    parser.add_argument(
+        "--candidate", nargs="*", default=[], metavar="KEY=VALUE",
+        help="`Kanachan` options of the candidate instance (e.g. bucketed_padding=true)",
+    )
+    parser.add_argument(
+        "--min-agreement",
+        type=float,
+        default=1.0,
+        help="exit with an error if the agreement is below this rate",
+    )
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_arguments(args)
+
+    from _kanachan import Kanachan
+
+    reference = Kanachan(**parse_options(args.reference))
+    candidate = Kanachan(**parse_options(args.candidate))
+    report = compare_decisions(
+        reference, candidate, list(iter_record_files(args.records)), args.seats
+    )
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+    if report["agreement_rate"] < args.min_agreement:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+from typing import (
+    List,
+    Optional,
+)
+
+from hand_calculator import calculate_hora_cost
+
+
+def _get_rank(scores: List[int], seat: int) -> int:
+    # `GameState.get_player_rank` と同じく，同点の場合は起家に近い方を上位とする．
+    rank = 0
+    for i in range(seat):
+        if scores[i] >= scores[seat]:
+            rank += 1
+    for i in range(seat + 1, 4):
+        if scores[i] > scores[seat]:
+            rank += 1
+    return rank
+
+
+def _is_all_last(game_state, round_state) -> bool:
+    # game_style == 0: 東風戦, game_style == 1: 半荘戦
+    last_chang = 0 if game_state.get_game_style() == 0 else 1
+    return round_state.get_chang() >= last_chang and round_state.get_index() == 3
+
+
+def all_last_hora(
+    game_state, round_state, dapai: Optional[int], candidates: List[int]
+) -> Optional[int]:
+    # オーラスで和了によって順位が上がるならば必ず和了する．
+    hora = None
+    for candidate in candidates:
+        if candidate == 219 or 543 <= candidate <= 545:
+            hora = candidate
+            break
+    if hora is None:
+        return None
+    if not _is_all_last(game_state, round_state):
+        return None
+
+    seat = game_state.get_seat()
+    index = round_state.get_index()
+    player_wind = (seat + 4 - index) % 4
+    rong = hora != 219
+    hupai = dapai if rong else round_state.get_zimo_tile()
+    if hupai is None:
+        return None
+
+    cost = calculate_hora_cost(
+        round_state.get_chang(),
+        player_wind,
+        round_state.get_my_hand(),
+        round_state.get_my_fulu_list(),
+        hupai,
+        rong,
+        round_state.get_dora_indicators(),
+        round_state.is_in_liqi(),
+    )
+    if cost is None:
+        return None
+
+    scores = [game_state.get_player_score(i) for i in range(4)]
+    ben_chang = round_state.get_num_ben_chang()
+    new_scores = list(scores)
+    if rong:
+        target = (seat + hora - 543 + 1) % 4
+        payment = cost["main"] + 300 * ben_chang
+        new_scores[target] -= payment
+        new_scores[seat] += payment
+    else:
+        for i in range(4):
+            if i == seat:
+                continue
+            if i == index or player_wind == 0:
+                payment = cost["main"]
+            else:
+                payment = cost["additional"]
+            payment += 100 * ben_chang
+            new_scores[i] -= payment
+            new_scores[seat] += payment
+    new_scores[seat] += 1000 * round_state.get_num_deposits()
+
+    if _get_rank(new_scores, seat) < _get_rank(scores, seat):
+        return hora
+    return None
+
+
+RULES = {
+    "all_last_hora": all_last_hora,
+}
@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+import argparse
+import asyncio
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+
+from batcher import InferenceBatcher
+from codec import CODECS, JsonCodec, get_codec
+from decision_cache import DecisionCache
+from instrumentation import Instrumentation
+from log import add_logging_arguments, configure_logging_from_arguments
+from metrics import Metrics, serve_metrics
+from profiling import ProfilingCapture
+
+
+async def serve_session(
+    reader: asyncio.StreamReader,
+    writer: asyncio.StreamWriter,
+    make_kanachan: Callable,
+    executor: ThreadPoolExecutor,
+    codec=None,
+    metrics=None,
+) -> None:
+    # 1つの接続が1つの対局に対応する．各フレームはイベントの配列 (または
+    # 単一のイベント) であり，それに対する応答を1フレームで返す．
+    if codec is None:
+        codec = JsonCodec()
+    loop = asyncio.get_running_loop()
+    kanachan = make_kanachan()
+    if metrics is not None:
+        metrics.add_session(kanachan)
+    try:
+        while True:
+            frame = await codec.read(reader)
+            if frame is None:
+                break
+            messages = codec.decode(frame)
+            if isinstance(messages, dict):
+                messages = [messages]
+            # 推論の完了を待つ間も他の対局のメッセージを処理できるように，
+            # `Kanachan.run` はスレッドプールで実行する．
+            response = await loop.run_in_executor(executor, kanachan.run, messages)
+            writer.write(codec.encode(response))
+            await writer.drain()
+    finally:
+        if metrics is not None:
+            metrics.remove_session(kanachan)
+        kanachan.close()
+        writer.close()
+
+
+async def _open_stdio(stdout) -> tuple:
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), sys.stdin
+    )
+    transport, protocol = await loop.connect_write_pipe(
+        asyncio.streams.FlowControlMixin, stdout
+    )
+    writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+    return reader, writer
+
+
+async def serve(
+    *,
+    make_kanachan: Callable,
+    executor: ThreadPoolExecutor,
+    codec=None,
+    metrics=None,
+    stdio: bool = False,
+    stdout=None,
+    host: str = None,
+    port: int = None,
+    unix_path: str = None,
+) -> None:
+    if stdio:
+        reader, writer = await _open_stdio(stdout if stdout is not None else sys.stdout)
+        await serve_session(reader, writer, make_kanachan, executor, codec, metrics)
+        return
+
+    async def on_connection(reader, writer):
+        await serve_session(reader, writer, make_kanachan, executor, codec, metrics)
+
+    if unix_path is not None:
+        server = await asyncio.start_unix_server(on_connection, path=unix_path)
+    else:
+        server = await asyncio.start_server(on_connection, host=host, port=port)
+    async with server:
+        await server.serve_forever()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Host many mjai games in one process with a shared inference scheduler."
+    )
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--stdio", action="store_true", help="serve one game over stdin/stdout")
+    group.add_argument("--tcp", metavar="HOST:PORT", help="listen on a local TCP socket")
+    group.add_argument("--unix", metavar="PATH", help="listen on a Unix domain socket")
+    parser.add_argument("--model", help="path to the model (default: the `Kanachan` default)")
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument(
+        "--codec",
+        choices=sorted(CODECS),
+        default="json",
+        help="`msgpack` uses length-prefixed frames and is meant for trusted local links",
+    )
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-delay", type=float, default=0.002, help="seconds")
+    parser.add_argument(
+        "--decision-cache-size",
+        type=int,
+        default=0,
+        help="entries of a decision cache shared by all games (0 disables it)",
+    )
+    parser.add_argument(
+        "--threads", type=int, default=64, help="threads running the rule logic of the games"
+    )
+    parser.add_argument(
+        "--metrics", metavar="HOST:PORT", help="serve Prometheus metrics over local HTTP"
+    )
+    parser.add_argument(
+        "--metrics-unix", metavar="PATH", help="serve Prometheus metrics over a Unix socket"
+    )
+    parser.add_argument(
+        "--profile-dir",
+        help="capture a profile into this directory on SIGUSR1 (see `profiling.py`)",
+    )
+    parser.add_argument(
+        "--profile-forward-passes", type=int, default=16, help="forward passes per capture"
+    )
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_arguments(args)
+
+    # 標準出力は応答のみに使う．ログは標準エラー出力またはファイルへ書き出す．
+    stdout = sys.stdout
+    if args.stdio:
+        sys.stdout = sys.stderr
+
+    from _kanachan import (
+        DEFAULT_MODEL_PATH,
+        Kanachan,
+        load_kanachan_model,
+        resolve_device,
+    )
+
+    codec = get_codec(args.codec)
+    device = resolve_device(args.device)
+    model_path = args.model if args.model is not None else DEFAULT_MODEL_PATH
+    model = load_kanachan_model(model_path, device, False)
+    batcher = InferenceBatcher(
+        model, device=device, max_batch_size=args.max_batch_size, max_delay=args.max_delay
+    )
+    Kanachan(batcher=batcher).warmup()
+
+    # 全てのセッションで1つのキャッシュを共有し，その統計をメトリクスに出す．
+    decision_cache = None
+    if args.decision_cache_size > 0:
+        decision_cache = DecisionCache(args.decision_cache_size)
+
+    executor = ThreadPoolExecutor(max_workers=args.threads, thread_name_prefix="KanachanSession")
+
+    # フォワードパスのレイテンシなどは計装から求めるので，メトリクスを
+    # 公開する場合にのみ計装を有効にする．
+    instrumentation = None
+    metrics = None
+    if args.metrics is not None or args.metrics_unix is not None:
+        instrumentation = Instrumentation()
+        metrics = Metrics(
+            instrumentation=instrumentation, batcher=batcher, decision_cache=decision_cache
+        )
+        if args.metrics_unix is not None:
+            serve_metrics(metrics, unix_path=args.metrics_unix)
+        else:
+            metrics_host, metrics_port = args.metrics.rsplit(":", 1)
+            serve_metrics(metrics, host=metrics_host, port=int(metrics_port))
+
+    profiler = None
+    if args.profile_dir is not None:
+        profiler = ProfilingCapture(
+            args.profile_dir, num_forward_passes=args.profile_forward_passes
+        )
+        profiler.install_signal_handler()
+
+    def make_kanachan():
+        return Kanachan(
+            batcher=batcher,
+            decision_cache=decision_cache,
+            instrumentation=instrumentation,
+            profiler=profiler,
+        )
+
+    host, port = None, None
+    if args.tcp is not None:
+        host, port = args.tcp.rsplit(":", 1)
+        port = int(port)
+
+    try:
+        asyncio.run(
+            serve(
+                make_kanachan=make_kanachan,
+                executor=executor,
+                codec=codec,
+                metrics=metrics,
+                stdio=args.stdio,
+                stdout=stdout,
+                host=host,
+                port=port,
+                unix_path=args.unix,
+            )
+        )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        executor.shutdown()
+        batcher.close()
+        if metrics is not None:
+            metrics.close()
+
+
+if __name__ == "__main__":
+    main()
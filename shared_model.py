@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+from queue import Empty
+from typing import (
+    List,
+    Optional,
+)
+
+import torch
+
+# `/proc/<pid>/smaps_rollup` の値は kB 単位である．
+_SMAPS_ROLLUP_KEYS = {
+    "Rss": "rss",
+    "Pss": "pss",
+    "Shared_Clean": "shared_clean",
+    "Shared_Dirty": "shared_dirty",
+    "Private_Clean": "private_clean",
+    "Private_Dirty": "private_dirty",
+}
+
+
+def memory_usage(pid: Optional[int] = None) -> dict:
+    path = f"/proc/{'self' if pid is None else pid}/smaps_rollup"
+    if not os.path.exists(path):
+        raise RuntimeError(f"{path} is not available on this platform.")
+    usage = {}
+    with open(path, encoding="UTF-8") as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) != 3 or fields[2] != "kB":
+                continue
+            key = fields[0].rstrip(":")
+            if key in _SMAPS_ROLLUP_KEYS:
+                usage[_SMAPS_ROLLUP_KEYS[key]] = int(fields[1]) * 1024
+    return usage
+
+
+def share_model(model: torch.nn.Module) -> torch.nn.Module:
+    # パラメータとバッファを共有メモリに移動する．fork された子プロセスは
+    # これらのストレージを複製せずに参照する．モデルは推論専用であり，
+    # 子プロセスがストレージに書き込むことはない．
+    model.share_memory()
+    for parameter in model.parameters():
+        parameter.requires_grad_(False)
+    return model
+
+
+def _run_worker(
+    index: int,
+    model: torch.nn.Module,
+    games: List[tuple],
+    queue,
+) -> None:
+    from _kanachan import Kanachan
+    from replay import split_messages
+
+    kanachan = Kanachan(model=model)
+    for seat, mjai_message_list in games:
+        for messages in split_messages(copy.deepcopy(mjai_message_list), seat):
+            kanachan.run(messages)
+
+    usage = memory_usage()
+    usage["worker"] = index
+    usage["pid"] = os.getpid()
+    usage["decisions"] = kanachan.get_stats()["decisions"]
+    queue.put(usage)
+
+
+def main() -> None:
+    from log import add_logging_arguments, configure_logging_from_arguments
+
+    parser = argparse.ArgumentParser(
+        description="Load a model once, share its weights with forked workers and report RSS/PSS per worker."
+    )
+    parser.add_argument("--model", help="path to the model (default: the `Kanachan` default)")
+    parser.add_argument("--records", required=True, help="directory of majsoul records to replay")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--seats", type=int, nargs="+", default=[0, 1, 2, 3])
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_arguments(args)
+
+    from _kanachan import DEFAULT_MODEL_PATH, load_kanachan_model
+    from convert_majsoul_to_mjai import parse_file
+    from replay import iter_record_files
+
+    model_path = args.model if args.model is not None else DEFAULT_MODEL_PATH
+    model = share_model(load_kanachan_model(model_path, torch.device("cpu"), False))
+    model_bytes = sum(
+        t.numel() * t.element_size() for t in model.state_dict().values()
+        if isinstance(t, torch.Tensor)
+    )
+
+    games = [[] for _ in range(args.workers)]
+    for i, file_path in enumerate(iter_record_files(args.records)):
+        for seat in args.seats:
+            games[i % args.workers].append(
+                (seat, parse_file(input_file_name=file_path, id=seat))
+            )
+
+    # `fork` でなければモデルが子プロセスに pickle されて複製される．
+    context = multiprocessing.get_context("fork")
+    queue = context.Queue()
+    processes = []
+    for i in range(args.workers):
+        process = context.Process(target=_run_worker, args=(i, model, games[i], queue))
+        process.start()
+        processes.append(process)
+
+    # ワーカーが結果を返す前に終了しても待ち続けないように，結果を待つ間も
+    # 各プロセスの終了を確認する．
+    results = {}
+    failed = {}
+    while len(results) + len(failed) < len(processes):
+        try:
+            usage = queue.get(timeout=1.0)
+            results[usage["worker"]] = usage
+        except Empty:
+            for i, process in enumerate(processes):
+                if i in results or i in failed:
+                    continue
+                if process.exitcode is not None and queue.empty():
+                    failed[i] = process.exitcode
+    for process in processes:
+        process.join()
+    if len(failed) > 0:
+        raise RuntimeError(
+            "Worker processes failed ("
+            + ", ".join(f"worker {i}: exitcode = {exitcode}" for i, exitcode in sorted(failed.items()))
+            + ")."
+        )
+    workers = [results[i] for i in sorted(results)]
+
+    print(
+        json.dumps(
+            {
+                "model_bytes": model_bytes,
+                "parent": memory_usage(),
+                "workers": workers,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,365 @@
+#!/usr/bin/env python3
+
+import argparse
+import bisect
+import copy
+import hashlib
+import itertools
+import json
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future
+from typing import (
+    List,
+    Optional,
+)
+
+from log import add_logging_arguments, configure_logging, configure_logging_from_arguments
+
+
+class _HashRing:
+    def __init__(self, num_nodes: int, num_replicas: int = 64) -> None:
+        # 各ワーカーを仮想ノードとして複数回リングに配置し，負荷を均す．
+        ring = []
+        for node in range(num_nodes):
+            for replica in range(num_replicas):
+                ring.append((self.__hash(f"worker-{node}#{replica}"), node))
+        ring.sort()
+        self.__hashes = [h for h, _ in ring]
+        self.__nodes = [node for _, node in ring]
+
+    @staticmethod
+    def __hash(key: str) -> int:
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+    def get_node(self, key: str) -> int:
+        i = bisect.bisect(self.__hashes, self.__hash(key))
+        return self.__nodes[i % len(self.__nodes)]
+
+
+def _run_worker(index: int, options: dict, requests, responses) -> None:
+    from _kanachan import (
+        DEFAULT_MODEL_PATH,
+        Kanachan,
+        configure_runtime,
+        load_kanachan_model,
+        resolve_device,
+    )
+
+    configure_logging(level=options["log_level"])
+    # モデルはワーカーごとに1度だけ読み込み，全てのセッションで共有する．
+    configure_runtime(
+        num_threads=options["num_threads"], num_interop_threads=1, cpu_affinity=None
+    )
+    device = resolve_device("cpu")
+    model_path = options["model_path"]
+    if model_path is None:
+        model_path = DEFAULT_MODEL_PATH
+    model = load_kanachan_model(model_path, device, options["quantize"])
+    Kanachan(model=model).warmup()
+
+    sessions = {}
+
+    def close_session(game_id: str) -> None:
+        kanachan = sessions.pop(game_id, None)
+        if kanachan is not None:
+            kanachan.close()
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, game_id, messages = request
+        try:
+            if messages is None:
+                close_session(game_id)
+                responses.put((request_id, None, None))
+                continue
+            kanachan = sessions.get(game_id)
+            if kanachan is None:
+                kanachan = Kanachan(model=model)
+                sessions[game_id] = kanachan
+            response = kanachan.run(messages)
+            if any(message["type"] == "end_game" for message in messages):
+                close_session(game_id)
+            responses.put((request_id, response, None))
+        except Exception as e:
+            close_session(game_id)
+            responses.put((request_id, None, f"{type(e).__name__}: {e}"))
+
+
+class Supervisor:
+    def __init__(
+        self,
+        num_workers: int,
+        *,
+        model_path: Optional[str] = None,
+        quantize: bool = False,
+        num_threads: int = 1,
+        num_replicas: int = 64,
+        poll_interval: float = 0.5,
+        log_level: str = "INFO",
+    ) -> None:
+        if num_workers < 1:
+            raise RuntimeError(f"An invalid number of workers (num_workers = {num_workers}).")
+        self.__num_workers = num_workers
+        self.__options = {
+            "model_path": model_path,
+            "quantize": quantize,
+            "num_threads": num_threads,
+            "log_level": log_level,
+        }
+        self.__ring = _HashRing(num_workers, num_replicas)
+        self.__poll_interval = poll_interval
+        # クラッシュしたワーカーはディスパッチャと監視のスレッドが動いている間に
+        # 再起動されるので， fork ではなく spawn で起動する．スレッドを持つ
+        # プロセスを fork すると，親が保持していたロックで子がデッドロックしうる．
+        self.__context = multiprocessing.get_context("spawn")
+        self.__responses = self.__context.Queue()
+        self.__workers = [None] * num_workers
+        self.__requests = [None] * num_workers
+        self.__lock = threading.Lock()
+        self.__pending = {}
+        self.__request_ids = itertools.count()
+        self.__num_restarts = 0
+        self.__closed = False
+        for i in range(num_workers):
+            self.__start_worker(i)
+
+        self.__dispatcher = threading.Thread(
+            target=self.__dispatch, name="SupervisorDispatcher", daemon=True
+        )
+        self.__dispatcher.start()
+        self.__monitor = threading.Thread(
+            target=self.__watch, name="SupervisorMonitor", daemon=True
+        )
+        self.__monitor.start()
+
+    def __start_worker(self, index: int) -> None:
+        requests = self.__context.Queue()
+        process = self.__context.Process(
+            target=_run_worker,
+            args=(index, self.__options, requests, self.__responses),
+            name=f"KanachanWorker-{index}",
+            daemon=True,
+        )
+        process.start()
+        self.__requests[index] = requests
+        self.__workers[index] = process
+
+    def __dispatch(self) -> None:
+        while True:
+            item = self.__responses.get()
+            if item is None:
+                break
+            request_id, response, error = item
+            with self.__lock:
+                pending = self.__pending.pop(request_id, None)
+            if pending is None:
+                continue
+            future = pending[1]
+            if error is not None:
+                future.set_exception(RuntimeError(error))
+            else:
+                future.set_result(response)
+
+    def __watch(self) -> None:
+        while True:
+            time.sleep(self.__poll_interval)
+            with self.__lock:
+                if self.__closed:
+                    break
+                for index, process in enumerate(self.__workers):
+                    if process.is_alive():
+                        continue
+                    # クラッシュしたワーカーのセッションは失われる．
+                    # 応答待ちの要求を失敗させ，同じ位置にワーカーを再起動する．
+                    lost = [
+                        request_id
+                        for request_id, (worker, _) in self.__pending.items()
+                        if worker == index
+                    ]
+                    for request_id in lost:
+                        _, future = self.__pending.pop(request_id)
+                        future.set_exception(
+                            RuntimeError(
+                                f"Worker {index} crashed (exitcode = {process.exitcode})."
+                            )
+                        )
+                    self.__start_worker(index)
+                    self.__num_restarts += 1
+
+    def get_worker(self, game_id: str) -> int:
+        return self.__ring.get_node(game_id)
+
+    def submit(self, game_id: str, messages: Optional[List[dict]]) -> Future:
+        index = self.get_worker(game_id)
+        future = Future()
+        request_id = next(self.__request_ids)
+        with self.__lock:
+            if self.__closed:
+                raise RuntimeError("The supervisor has already been closed.")
+            self.__pending[request_id] = (index, future)
+            self.__requests[index].put((request_id, game_id, messages))
+        return future
+
+    def request(self, game_id: str, messages: List[dict], timeout: Optional[float] = None) -> dict:
+        return self.submit(game_id, messages).result(timeout)
+
+    def close_session(self, game_id: str) -> None:
+        self.submit(game_id, None).result()
+
+    def get_stats(self) -> dict:
+        with self.__lock:
+            return {
+                "workers": self.__num_workers,
+                "pids": [process.pid for process in self.__workers],
+                "restarts": self.__num_restarts,
+                "pending": len(self.__pending),
+            }
+
+    def close(self) -> None:
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            for requests in self.__requests:
+                requests.put(None)
+        for process in self.__workers:
+            process.join()
+        self.__responses.put(None)
+        self.__dispatcher.join()
+        self.__monitor.join()
+
+
+def _run_client(
+    index: int,
+    supervisor: Supervisor,
+    games: List[tuple],
+    deadline: float,
+    results: list,
+) -> None:
+    from replay import split_messages
+
+    num_decisions = 0
+    num_failures = 0
+    i = index
+    while time.perf_counter() < deadline:
+        seat, mjai_message_list = games[i % len(games)]
+        game_id = f"client-{index}/game-{i}"
+        i += 1
+        try:
+            for messages in split_messages(copy.deepcopy(mjai_message_list), seat):
+                response = supervisor.request(game_id, messages)
+                if response["type"] != "none":
+                    num_decisions += 1
+                if time.perf_counter() >= deadline:
+                    break
+        except RuntimeError:
+            num_failures += 1
+        supervisor.close_session(game_id)
+    results[index] = (num_decisions, num_failures)
+
+
+def measure(
+    *,
+    games: List[tuple],
+    num_workers: int,
+    num_clients: int,
+    duration: float,
+    model_path: Optional[str],
+    quantize: bool,
+    num_threads: int,
+    log_level: str = "INFO",
+) -> dict:
+    supervisor = Supervisor(
+        num_workers,
+        model_path=model_path,
+        quantize=quantize,
+        num_threads=num_threads,
+        log_level=log_level,
+    )
+    try:
+        # 全てのワーカーがモデルを読み込むまで待ってから計測を始める．
+        for i in range(num_workers):
+            game_id = next(
+                f"ready-{i}-{j}" for j in itertools.count()
+                if supervisor.get_worker(f"ready-{i}-{j}") == i
+            )
+            supervisor.close_session(game_id)
+
+        results = [None] * num_clients
+        start = time.perf_counter()
+        deadline = start + duration
+        clients = [
+            threading.Thread(
+                target=_run_client, args=(i, supervisor, games, deadline, results)
+            )
+            for i in range(num_clients)
+        ]
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.perf_counter() - start
+        stats = supervisor.get_stats()
+    finally:
+        supervisor.close()
+
+    num_decisions = sum(n for n, _ in results)
+    return {
+        "workers": num_workers,
+        "decisions_per_second": num_decisions / elapsed,
+        "failed_games": sum(n for _, n in results),
+        "restarts": stats["restarts"],
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Serve games on pre-started worker processes and report decisions/sec as the worker count grows."
+    )
+    parser.add_argument("--model", help="path to the model (default: the `Kanachan` default)")
+    parser.add_argument("--quantize", action="store_true")
+    parser.add_argument("--records", required=True, help="directory of majsoul records to replay")
+    parser.add_argument("--seats", type=int, nargs="+", default=[0, 1, 2, 3])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--clients", type=int, help="concurrent games (default: 4 per worker)")
+    parser.add_argument("--threads", type=int, default=1, help="intra-op threads per worker")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per setting")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_arguments(args)
+
+    from convert_majsoul_to_mjai import parse_file
+    from replay import iter_record_files
+
+    games = []
+    for file_path in iter_record_files(args.records):
+        for seat in args.seats:
+            games.append((seat, parse_file(input_file_name=file_path, id=seat)))
+    if len(games) == 0:
+        raise RuntimeError(f"No records found in {args.records}.")
+
+    results = []
+    for num_workers in args.workers:
+        result = measure(
+            games=games,
+            num_workers=num_workers,
+            num_clients=args.clients if args.clients is not None else 4 * num_workers,
+            duration=args.duration,
+            model_path=args.model,
+            quantize=args.quantize,
+            num_threads=args.threads,
+            log_level=args.log_level,
+        )
+        results.append(result)
+        print(
+            f"workers = {num_workers}: {result['decisions_per_second']:.1f} decisions/sec"
+        )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
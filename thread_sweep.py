@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import argparse
+import copy
+import json
+import multiprocessing
+import os
+import time
+from queue import Empty
+from typing import (
+    List,
+    Optional,
+)
+
+from convert_majsoul_to_mjai import parse_file
+from log import add_logging_arguments, configure_logging, configure_logging_from_arguments
+from replay import iter_record_files, split_messages
+
+
+def _run_table(
+    index: int,
+    games: List[tuple],
+    num_threads: int,
+    num_interop_threads: Optional[int],
+    cpu_affinity: Optional[List[int]],
+    duration: float,
+    barrier,
+    queue,
+    log_level: str,
+) -> None:
+    from _kanachan import Kanachan
+
+    configure_logging(level=log_level)
+
+    kanachan = Kanachan(
+        num_threads=num_threads,
+        num_interop_threads=num_interop_threads,
+        cpu_affinity=cpu_affinity,
+    )
+    kanachan.warmup()
+
+    # 全てのテーブルがモデルの読み込みとウォームアップを終えてから計測を始める．
+    barrier.wait()
+    start = time.perf_counter()
+    deadline = start + duration
+    num_decisions = kanachan.get_stats()["decisions"]
+    i = index
+    while time.perf_counter() < deadline:
+        seat, mjai_message_list = games[i % len(games)]
+        i += 1
+        for messages in split_messages(copy.deepcopy(mjai_message_list), seat):
+            kanachan.run(messages)
+            if time.perf_counter() >= deadline:
+                break
+    elapsed = time.perf_counter() - start
+    queue.put((index, kanachan.get_stats()["decisions"] - num_decisions, elapsed))
+
+
+def measure(
+    *,
+    games: List[tuple],
+    num_tables: int,
+    num_threads: int,
+    num_interop_threads: Optional[int],
+    pin: bool,
+    duration: float,
+    log_level: str = "INFO",
+) -> float:
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(num_tables)
+    queue = context.Queue()
+    num_cpus = os.cpu_count()
+
+    processes = []
+    for i in range(num_tables):
+        cpu_affinity = None
+        if pin:
+            cpu_affinity = [(i * num_threads + j) % num_cpus for j in range(num_threads)]
+        process = context.Process(
+            target=_run_table,
+            args=(
+                i,
+                games,
+                num_threads,
+                num_interop_threads,
+                cpu_affinity,
+                duration,
+                barrier,
+                queue,
+                log_level,
+            ),
+        )
+        process.start()
+        processes.append(process)
+
+    # テーブルのプロセスが結果を返す前に終了しても待ち続けないように，
+    # 結果を待つ間も各プロセスの終了を確認する．
+    results = {}
+    failed = {}
+    while len(results) + len(failed) < num_tables:
+        try:
+            index, num_decisions, elapsed = queue.get(timeout=1.0)
+            results[index] = (num_decisions, elapsed)
+        except Empty:
+            for i, process in enumerate(processes):
+                if i in results or i in failed:
+                    continue
+                if process.exitcode is not None and queue.empty():
+                    failed[i] = process.exitcode
+                    # 残りのテーブルが `barrier` で待ち続けないようにする．
+                    barrier.abort()
+    for process in processes:
+        process.join()
+    if len(failed) > 0:
+        raise RuntimeError(
+            "Table processes failed ("
+            + ", ".join(f"table {i}: exitcode = {exitcode}" for i, exitcode in sorted(failed.items()))
+            + ")."
+        )
+
+    return sum(num_decisions / elapsed for num_decisions, elapsed in results.values())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Find the intra-op thread count giving the best decisions/sec at a given number of concurrent tables."
+    )
+    parser.add_argument("--records", required=True, help="directory of majsoul records to replay")
+    parser.add_argument("--tables", type=int, required=True, help="number of concurrent tables")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--interop-threads", type=int, default=1)
+    parser.add_argument("--seats", type=int, nargs="+", default=[0, 1, 2, 3])
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per setting")
+    parser.add_argument("--pin", action="store_true", help="pin each table to its own CPUs")
+    add_logging_arguments(parser)
+    args = parser.parse_args()
+    configure_logging_from_arguments(args)
+
+    games = []
+    for file_path in iter_record_files(args.records):
+        for seat in args.seats:
+            games.append((seat, parse_file(input_file_name=file_path, id=seat)))
+    if len(games) == 0:
+        raise RuntimeError(f"No records found in {args.records}.")
+
+    results = {}
+    for num_threads in args.threads:
+        decisions_per_second = measure(
+            games=games,
+            num_tables=args.tables,
+            num_threads=num_threads,
+            num_interop_threads=args.interop_threads,
+            pin=args.pin,
+            duration=args.duration,
+            log_level=args.log_level,
+        )
+        results[num_threads] = decisions_per_second
+        print(f"num_threads = {num_threads}: {decisions_per_second:.1f} decisions/sec")
+
+    best = max(results, key=results.get)
+    print(
+        json.dumps(
+            {
+                "tables": args.tables,
+                "interop_threads": args.interop_threads,
+                "decisions_per_second": results,
+                "best_num_threads": best,
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()